@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+
+# Same as MAX_FRAME_SIZE in run.py, test_run.py checks that they match
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+TOKEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../initramfs/usr/share/app-manager/ratls/token.bin")
+
+# Loopback address of vsock, needs the vsock_loopback module
+VMADDR_CID_LOCAL = 1
+
+IF_ADDRS = {
+    "lo": {"address": "127.0.0.1", "netmask": "255.0.0.0", "destination": None},
+    "eth0": {"address": "192.168.100.237", "netmask": "255.255.255.0", "destination": "192.168.100.255"},
+}
+
+class FakeAppManager():
+    """Answers requests the way app-manager does, without installing anything
+
+    Applications only have a status, `None` when not started, `True` when
+    running. Every request takes its configured service time to complete.
+    """
+
+    def __init__(self, service_times, default_service_time, token, autostartall = True):
+        self.service_times = service_times
+        self.default_service_time = default_service_time
+        self.token = token
+        self.autostartall = autostartall
+        self.apps = {}
+        self.provisioned = False
+
+    def provision(self, apps):
+        if self.provisioned:
+            return {"Error": {"ProvisioningError": "AlreadyProvisioned"}}
+
+        self.provisioned = True
+        for app in apps:
+            self.apps[app["id"]] = True if self.autostartall else None
+        return {"Success": []}
+
+    def attestation_token(self, challenge):
+        if len(challenge) != 64:
+            return {"Error": {"AttestationTokenReadingError": "InvalidChallengeSize"}}
+
+        # Bind the token to the challenge so the host can tell responses apart
+        return {"AttestationToken": list(hashlib.sha256(bytes(challenge)).digest() + self.token)}
+
+    def app_action(self, id, action):
+        if id not in self.apps:
+            return {"Error": {"ApplicationNotFound": []}}
+
+        running = self.apps[id] is True
+        if action == "CheckStatus":
+            return {"ApplicationIsRunning": []} if running else {"ApplicationNotStarted": []}
+        if action == "StartApp":
+            if running:
+                return {"Error": {"ApplicationLaunchFailed": "AppAlreadyRunning"}}
+            self.apps[id] = True
+            return {"Success": []}
+
+        if not running:
+            return {"Error": {f"Application{action[:-3]}Failed": "AppNotRunning"}}
+        self.apps[id] = None
+        return {"Success": []}
+
+    def handle(self, req):
+        if not isinstance(req, dict) or len(req) != 1:
+            return {"Error": {"InvalidRequest": f"Unknown request {req}"}}
+
+        [(name, arg)] = req.items()
+        if name == "ProvisionInfo":
+            return self.provision(arg)
+        if name == "GetAttestationToken":
+            return self.attestation_token(arg)
+        if name == "GetIfAddrs":
+            return {"IfAddrs": IF_ADDRS}
+        if name in ("CheckStatus", "StartApp", "StopApp", "KillApp"):
+            return self.app_action(arg, name)
+
+        return {"Error": {"InvalidRequest": f"Unknown request {name}"}}
+
+    async def serve(self, reader, writer):
+        """Handles requests until the host disconnects or a power action arrives"""
+        while True:
+            try:
+                l = struct.unpack(">I", await reader.readexactly(4))[0]
+                if l > MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame of {l} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes")
+                data = await reader.readexactly(l)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return None
+
+            try:
+                req = json.loads(data)
+            except ValueError as e:
+                req = None
+                resp = {"Error": {"InvalidRequest": str(e)}}
+
+            name = next(iter(req)) if isinstance(req, dict) and req else None
+            await asyncio.sleep(self.service_times.get(name, self.default_service_time))
+
+            if name in ("Reboot", "Shutdown"):
+                return name
+            if req is not None:
+                resp = self.handle(req)
+
+            s = json.dumps(resp).encode()
+            writer.write(struct.pack(">I", len(s)) + s)
+            await writer.drain()
+
+async def connect(args, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            if args.unix:
+                reader, writer = await asyncio.open_unix_connection(args.unix)
+                # asyncio takes EAGAIN from a full backlog for a finished connect
+                try:
+                    writer.get_extra_info("socket").getpeername()
+                except OSError:
+                    writer.close()
+                    raise
+                return reader, writer
+
+            sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM, 0)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, (args.vsock_cid, args.vsock_port))
+            except OSError:
+                sock.close()
+                raise
+            return await asyncio.open_connection(sock=sock)
+        except OSError:
+            if loop.time() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+async def run_instance(args, service_times, token):
+    await asyncio.sleep(args.boot_time)
+
+    while True:
+        reader, writer = await connect(args, args.connect_timeout)
+        realm = FakeAppManager(service_times, args.service_time, token, not args.no_autostart)
+        action = await realm.serve(reader, writer)
+        writer.close()
+
+        if action != "Reboot":
+            return
+        await asyncio.sleep(args.boot_time)
+
+def parse_service_time(value):
+    name, _, seconds = value.partition("=")
+    return name, float(seconds)
+
+async def run(args):
+    service_times = dict(args.service_time_for)
+    try:
+        with open(args.token_file, "rb") as f:
+            token = f.read()
+    except OSError:
+        token = bytes(args.token_size)
+
+    await asyncio.gather(*[run_instance(args, service_times, token) for _ in range(args.instances)])
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for app-manager speaking the realm protocol to run.py")
+    parser.add_argument("--unix", type=str, help="Connect to the host over this unix socket instead of vsock")
+    parser.add_argument("--vsock-cid", type=int, default=VMADDR_CID_LOCAL)
+    parser.add_argument("--vsock_port", type=int, default=1337)
+    parser.add_argument("--instances", type=int, default=1, help="Number of realms simulated by this process, each gets its own connection")
+    parser.add_argument("--service-time", type=float, default=0.0, help="Seconds every request takes to handle")
+    parser.add_argument("--service-time-for", type=parse_service_time, action="append", default=[], metavar="REQUEST=SECONDS",
+                        help="Service time of one request type, e.g. ProvisionInfo=0.5, can be repeated")
+    parser.add_argument("--boot-time", type=float, default=0.0, help="Seconds before connecting, also after every reboot")
+    parser.add_argument("--connect-timeout", type=float, default=30.0)
+    parser.add_argument("--no-autostart", action="store_true", default=False, help="Do not start applications after provisioning")
+    parser.add_argument("--token-file", type=str, default=TOKEN_FILE, help="Attestation token returned after the challenge hash")
+    parser.add_argument("--token-size", type=int, default=1086, help="Size of the zeroed token used when --token-file is missing")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import collections
+import fcntl
+import hashlib
+import io
+import itertools
+import re
+import time
 import uuid
 import shlex
+import signal
 import json
 import sys
 import subprocess
 import os
 import socket
 import struct
-from typing import List
-from dataclasses import dataclass
-from gpt_image.disk import Disk
-from gpt_image.partition import Partition, PartitionType
+import threading
+from typing import List, Tuple
+from dataclasses import dataclass, asdict, fields, replace
 
 APP_ID = uuid.UUID("5d63a211-e8aa-4179-ac22-af7e843a3f43")
 IMAGE_UUID = "0178460a-ffea-4674-8e17-8530758c4c2e"
 DATA_UUID = "259c493c-e5d2-4fd4-a962-7efd45a0bd91"
+TEMPLATE_DIR = "disk-templates"
+QEMU_IMG = "../tools/qemu/build/qemu-img"
+FAKE_REALM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_realm.py")
+# From linux/fs.h
+FICLONE = 0x40049409
+DEFAULT_MAC = "52:55:00:d1:55:01"
+# Same as the default limit of tokio's LengthDelimitedCodec used by app-manager
+MAX_FRAME_SIZE = 8 * 1024 * 1024
 
 @dataclass()
 class App:
@@ -27,64 +43,1301 @@ class App:
     image_part_uuid: str
     data_part_uuid: str
 
+def default_apps(im_url = None):
+    if im_url:
+        return [App(id=str(APP_ID), name="exmapleapp", version="latest", image_registry=im_url,
+                    image_part_uuid=str(IMAGE_UUID), data_part_uuid=str(DATA_UUID))]
+
+    return [App(id=str(APP_ID), name="Test app", version="1.0", image_registry="http://registry.com",
+                image_part_uuid=str(IMAGE_UUID), data_part_uuid=str(DATA_UUID))]
+
+@dataclass()
+class RealmSlot:
+    index: int
+    guest_cid: int
+    tap_device: str
+    mac: str
+    disk: str
+    qemu_serial: str
+
+def allocate_realms(count, guest_cid, tap_device, mac = DEFAULT_MAC):
+    """Hands out unique CIDs, taps, MACs, disks and serial logs for a fleet of realms
+
+    Tap names are derived by incrementing the trailing number of `tap_device`
+    (tap100, tap101, ...), the devices have to be created beforehand.
+    """
+    tap_prefix, tap_number = re.match(r"(.*?)(\d*)$", tap_device).groups()
+    tap_number = int(tap_number or 0)
+    mac_base = int(mac.replace(":", ""), 16)
+
+    slots = []
+    for i in range(count):
+        m = f"{mac_base + i:012x}"
+        slots.append(RealmSlot(
+            index=i,
+            guest_cid=guest_cid + i,
+            tap_device=f"{tap_prefix}{tap_number + i}",
+            mac=":".join(m[j:j + 2] for j in range(0, 12, 2)),
+            disk=f"disk-{i}.raw",
+            qemu_serial=f"file:serial-{i}.log",
+        ))
+
+    return slots
+
+@dataclass(frozen=True)
+class PartitionSpec:
+    name: str
+    size: int
+    guid: str
+    # File copied into the partition, e.g. a pre-formatted filesystem
+    content: str = None
+
+@dataclass(frozen=True)
+class DiskLayout:
+    size: int
+    partitions: Tuple[PartitionSpec, ...]
+    # In sectors, gpt_image's default
+    alignment: int = 8
+
+    def key(self):
+        return hashlib.sha256(json.dumps(asdict(self), sort_keys=True).encode()).hexdigest()[:16]
+
+DEFAULT_LAYOUT = DiskLayout(size=1024 * 1024 * 1024, partitions=(
+    PartitionSpec("image", 256 * 1024 * 1024, IMAGE_UUID),
+    PartitionSpec("data", 256 * 1024 * 1024, DATA_UUID),
+))
+
+SECTOR_SIZE = 512
+# 1 MiB, the partition alignment used by parted and sgdisk
+PARTITION_ALIGNMENT = 2048
+# Entries of a GPT partition array
+MAX_PARTITIONS = 128
+GPT_SECTORS = 33
+
+@dataclass()
+class AppDisk:
+    app: App
+    image_size: int = 256 * 1024 * 1024
+    data_size: int = 256 * 1024 * 1024
+
+def build_layout(app_disks: List[AppDisk], alignment = PARTITION_ALIGNMENT, preformat = False, vendor_data = None):
+    """Lays out an image and a data partition for every app and returns the layout and the apps
+
+    Empty application ids and partition GUIDs are generated, so the returned
+    App records are ready for provisioning on a disk built from the layout.
+    Partitions are packed back to back on `alignment` sector boundaries and
+    the disk is just big enough to hold them and the backup GPT.
+
+    With `preformat` the partitions hold encrypted ext2 filesystems that a
+    realm using the Dummy key sealing mounts without running mkfs, see
+    dummy_partition_keys().
+    """
+    if 2 * len(app_disks) > MAX_PARTITIONS:
+        raise ValueError(f"{len(app_disks)} apps need {2 * len(app_disks)} partitions, a GPT holds {MAX_PARTITIONS}")
+
+    def aligned(sectors):
+        return -(-sectors // alignment) * alignment
+
+    apps = []
+    partitions = []
+    end = max(alignment, GPT_SECTORS + 2)
+    for i, d in enumerate(app_disks):
+        app = replace(d.app, id=d.app.id or str(uuid.uuid4()),
+                      image_part_uuid=d.app.image_part_uuid or str(uuid.uuid4()),
+                      data_part_uuid=d.app.data_part_uuid or str(uuid.uuid4()))
+        apps.append(app)
+        keys = dummy_partition_keys(app, vendor_data) if preformat else (None, None)
+        for (name, size, guid), key in zip([("image", d.image_size, app.image_part_uuid), ("data", d.data_size, app.data_part_uuid)], keys):
+            content = preformatted_image(size, name, key) if preformat else None
+            partitions.append(PartitionSpec(f"{name}-{i}", size, guid, content))
+            end = aligned(end) + -(-size // SECTOR_SIZE)
+
+    size = aligned(end + GPT_SECTORS + 1) * SECTOR_SIZE
+    return DiskLayout(size=size, partitions=tuple(partitions), alignment=alignment), apps
+
+def multi_app_layout(count, base_app, partition_size = 256 * 1024 * 1024, preformat = False, vendor_data = None):
+    """Returns a layout and `count` copies of `base_app`, each with its own id and partitions
+
+    The ids and GUIDs are derived from `count` and the app index, so the
+    same count always maps to the same layout and reuses its template disk.
+    """
+    def derived(i, name):
+        return str(uuid.uuid5(APP_ID, f"{count}-{i}-{name}"))
+
+    copies = [replace(base_app, id=derived(i, "app"), image_part_uuid=derived(i, "image"), data_part_uuid=derived(i, "data")) for i in range(count)]
+    return build_layout([AppDisk(app, partition_size, partition_size) for app in copies], preformat=preformat, vendor_data=vendor_data)
+
+# app-manager's Dummy key sealing (key/dummy.rs) and the vendor data of its Dummy launcher
+DUMMY_IKM = bytes([0x11, 0x22, 0x33])
+DUMMY_VENDOR_DATA = [bytes([0x11, 0x22, 0x33])]
+
+def dummy_derive_key(ikm, infos):
+    return hashlib.sha256(ikm + b"".join(infos)).digest()
+
+def dummy_partition_keys(app, vendor_data = None):
+    """Returns the dm-crypt keys of the image and data partition of `app` under the Dummy key sealing
+
+    Mirrors Application::setup(). The image key only depends on a fixed
+    label, the data key is derived after sealing with the vendor data the
+    launcher returns on installation (the image hash is ignored by the Dummy
+    sealing).
+    """
+    if vendor_data is None:
+        vendor_data = DUMMY_VENDOR_DATA
+    image_key = dummy_derive_key(DUMMY_IKM, [b"App manager label"])
+    sealed = dummy_derive_key(DUMMY_IKM, vendor_data)
+    data_key = dummy_derive_key(sealed, [app.name.encode()])
+    return image_key, data_key
+
+def encrypt_aes_cbc_plain(src, dst, key, chunk_size = 1024 * 1024):
+    """Encrypts `src` like a dm-crypt aes-cbc-plain device with iv_offset 0 would store it
+
+    Every 512 byte sector is encrypted on its own, its IV is the 32 bit little
+    endian sector number. As CBC only chains within a sector, a chunk is
+    encrypted a block column at a time: the n-th block of every sector is
+    XORed with the previous block of its sector and all of them go through
+    a single ECB call.
+    """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+    iv = struct.Struct("<I12x")
+    # blocks are moved as two 8 byte words, a sector is 64 of them
+    words = SECTOR_SIZE // 8
+    sector = 0
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        while data := s.read(chunk_size):
+            count = len(data) // SECTOR_SIZE
+            out = bytearray(len(data))
+            column = bytearray(count * iv.size)
+            plain, cipher, mixed = (memoryview(b).cast("Q") for b in (data, out, column))
+            previous = b"".join(iv.pack((sector + i) & 0xffffffff) for i in range(count))
+            for word in range(0, words, 2):
+                mixed[0::2], mixed[1::2] = plain[word::words], plain[word + 1::words]
+                xored = int.from_bytes(column, "little") ^ int.from_bytes(previous, "little")
+                previous = encryptor.update(xored.to_bytes(len(column), "little"))
+                encrypted = memoryview(previous).cast("Q")
+                cipher[word::words], cipher[word + 1::words] = encrypted[0::2], encrypted[1::2]
+            d.write(out)
+            sector += count
+
+def preformatted_image(size, label, key):
+    """Returns a cached encrypted ext2 image of `size` bytes, formatted like app-manager's formatfs() does"""
+    name = hashlib.sha256(key + label.encode() + str(size).encode()).hexdigest()[:16]
+    path = os.path.join(TEMPLATE_DIR, f"ext2-{name}.img")
+    if not os.path.isfile(path):
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        plain = f"{path}.{os.getpid()}.plain"
+        tmp = f"{path}.{os.getpid()}.tmp"
+        start = time.perf_counter()
+        with open(plain, "xb") as f:
+            f.truncate(size)
+        try:
+            subprocess.run(["mkfs.ext2", "-q", "-F", "-L", label, plain], check=True)
+            encrypt_aes_cbc_plain(plain, tmp, key)
+        finally:
+            os.unlink(plain)
+        os.replace(tmp, path)
+        print(f"Pre-formatted {label} partition image {path} in {time.perf_counter() - start:.1f}s")
+
+    return path
+
+def copy_into(src, dst, offset):
+    with open(src, "rb") as s, open(dst, "r+b") as d:
+        pos = 0
+        size = os.fstat(s.fileno()).st_size
+        while pos < size:
+            pos += os.copy_file_range(s.fileno(), d.fileno(), size - pos, pos, offset + pos)
+
+def gpt_table(layout):
+    """Returns the Geometry and the Table of a disk with the layout's partitions
+
+    Partitions are only placed by PartitionEntryArray.add(), the table is
+    never committed through a Disk. Disk.commit() moves partition data
+    through a temporary copy of the whole image, which writes out every hole.
+    """
+    from gpt_image.geometry import Geometry
+    from gpt_image.partition import Partition, PartitionType
+    from gpt_image.table import Table
+
+    geometry = Geometry(layout.size, SECTOR_SIZE)
+    table = Table(geometry)
+    for p in layout.partitions:
+        table.partitions.add(Partition(p.name, p.size, PartitionType.LINUX_FILE_SYSTEM.value, partition_guid=p.guid, alignment=layout.alignment))
+    table.update()
+    return geometry, table
+
+def write_gpt(path, layout):
+    """Writes the protective MBR, both GPT headers and partition arrays and the partition contents"""
+    geometry, table = gpt_table(layout)
+    with open(path, "r+b") as f:
+        for offset, data in [
+            (0, table.protective_mbr.marshal()),
+            (geometry.primary_header_byte, table.primary_header.marshal()),
+            (geometry.primary_array_byte, table.partitions.marshal()),
+            (geometry.alternate_header_byte, table.secondary_header.marshal()),
+            (geometry.alternate_array_byte, table.partitions.marshal()),
+        ]:
+            f.seek(offset)
+            f.write(data)
+
+    for p, partition in zip(layout.partitions, table.partitions.entries):
+        if p.content is not None:
+            copy_into(p.content, path, partition.first_lba_staged * SECTOR_SIZE)
+
+def create_disk(path, layout = DEFAULT_LAYOUT):
+    """Creates a sparse GPT disk
+
+    Disk.create() zeroes the whole image with a single write. A fresh file
+    extended with truncate is already all holes, so only the protective MBR,
+    both GPT headers and both partition arrays get written.
+    """
+    with open(path, "xb") as f:
+        f.truncate(layout.size)
+    write_gpt(path, layout)
+
+def create_zeroed_disk(path, layout = DEFAULT_LAYOUT):
+    from gpt_image.disk import Disk
+
+    Disk(path).create(layout.size)
+    write_gpt(path, layout)
+
+def written_bytes():
+    with open("/proc/self/io") as f:
+        return int(dict(l.split(": ") for l in f.read().splitlines())["wchar"])
+
+def bench_disk_creation(layout = DEFAULT_LAYOUT, rounds = 3):
+    os.makedirs(TEMPLATE_DIR, exist_ok=True)
+    path = os.path.join(TEMPLATE_DIR, f"bench-{os.getpid()}.raw")
+
+    for name, create in [("Disk.create", create_zeroed_disk), ("sparse", create_disk)]:
+        for i in range(rounds):
+            written = written_bytes()
+            start = time.perf_counter()
+            create(path, layout)
+            elapsed = time.perf_counter() - start
+            written = written_bytes() - written
+            allocated = os.stat(path).st_blocks * 512
+            os.unlink(path)
+            print(f"{name:12} round {i}: {elapsed * 1000:9.1f} ms, {written:>11} bytes written, {allocated:>11} bytes allocated")
+
+def template_disk(layout = DEFAULT_LAYOUT):
+    """Returns the golden disk for `layout`, building it on first use"""
+    path = os.path.join(TEMPLATE_DIR, f"disk-{layout.key()}.raw")
+    if not os.path.isfile(path):
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        create_disk(tmp, layout)
+        os.replace(tmp, path)
+
+    return path
+
+def reflink(src, dst):
+    with open(src, "rb") as s, open(dst, "xb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+
+def sparse_copy(src, dst):
+    """Copies only the allocated extents of `src`, holes stay holes in `dst`"""
+    with open(src, "rb") as s, open(dst, "xb") as d:
+        size = os.fstat(s.fileno()).st_size
+        d.truncate(size)
+        pos = 0
+        while pos < size:
+            try:
+                pos = os.lseek(s.fileno(), pos, os.SEEK_DATA)
+            except OSError:
+                # Nothing but a hole till the end of the file
+                break
+            end = os.lseek(s.fileno(), pos, os.SEEK_HOLE)
+            while pos < end:
+                pos += os.copy_file_range(s.fileno(), d.fileno(), end - pos, pos, pos)
+
+def qcow2_overlay(src, dst):
+    subprocess.run([QEMU_IMG, "create", "-q", "-f", "qcow2", "-F", "raw", "-b", os.path.abspath(src), dst], check=True)
+
+def clone_disk(template, path, method = "auto"):
+    """Creates a per-realm disk from `template` and returns its path
+
+    `auto` tries a reflink first and falls back to a sparse copy. A qcow2
+    overlay is only made on request since it changes the disk format.
+
+    An existing disk is reused when `<path>.template` names `template`,
+    otherwise it was cloned for another layout and is replaced.
+    """
+    if method == "qcow2":
+        path = os.path.splitext(path)[0] + ".qcow2"
+    source = f"{path}.template"
+    if os.path.isfile(path):
+        if os.path.isfile(source):
+            with open(source) as f:
+                if f.read() == template:
+                    return path
+        print(f"{path} was not cloned from {template}, cloning it again")
+        os.unlink(path)
+
+    start = time.perf_counter()
+    if method == "qcow2":
+        qcow2_overlay(template, path)
+    elif method == "copy":
+        sparse_copy(template, path)
+    else:
+        try:
+            reflink(template, path)
+            method = "reflink"
+        except OSError:
+            if method == "reflink":
+                raise
+            sparse_copy(template, path)
+            method = "copy"
+
+    with open(source, "w") as f:
+        f.write(template)
+    print(f"Cloned {template} to {path} ({method}) in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return path
+
+def prepare_disk(path, layout = DEFAULT_LAYOUT, method = "auto"):
+    return clone_disk(template_disk(layout), path, method)
+
+@dataclass(frozen=True)
+class QemuConfig:
+    """Emulated CPU, topology, accelerator and disk backend of a realm
+
+    `thread` (single or multi) and `tb_size` (translation cache in MiB) only
+    apply to TCG, QEMU picks its own defaults when they are None.
+
+    The disk is attached with a plain `-drive file=` unless one of the disk
+    options is set. It is then an `if=none` drive with an explicit format,
+    plugged into `disk_device` (virtio-blk-pci by default), optionally
+    served by its own iothread.
+
+    `vhost` and `queues` only apply to virtio-net NICs. Multiqueue needs a
+    tap created with `multi_queue`.
+    """
+    cpu: str = "cortex-a57"
+    smp: int = 1
+    memory: int = 2048
+    accel: str = "tcg"
+    thread: str = None
+    tb_size: int = None
+    disk_device: str = None
+    aio: str = None
+    cache: str = None
+    iothread: bool = False
+    nic: str = "e1000"
+    vhost: bool = False
+    queues: int = None
+
+    def __post_init__(self):
+        if self.aio == "native" and self.cache not in ("none", "directsync"):
+            raise ValueError("aio=native needs cache=none or cache=directsync")
+        if (self.vhost or self.queues) and not self.nic.startswith("virtio-net"):
+            raise ValueError(f"vhost and queues need a virtio-net NIC, not {self.nic}")
+
+    def accel_arg(self):
+        arg = self.accel
+        if self.accel == "tcg":
+            if self.thread is not None:
+                arg += f",thread={self.thread}"
+            if self.tb_size is not None:
+                arg += f",tb-size={self.tb_size}"
+        return arg
+
+    def disk_args(self, disk):
+        if not (self.disk_device or self.aio or self.cache or self.iothread):
+            return f"-drive file={disk}"
+
+        fmt = "qcow2" if disk.endswith(".qcow2") else "raw"
+        drive = f"file={disk},format={fmt},if=none,id=disk0"
+        if self.aio is not None:
+            drive += f",aio={self.aio}"
+        if self.cache is not None:
+            drive += f",cache={self.cache}"
+        device = f"{self.disk_device or 'virtio-blk-pci'},drive=disk0"
+        if self.iothread:
+            return f"-object iothread,id=iothread0 -drive {drive} -device {device},iothread=iothread0"
+        return f"-drive {drive} -device {device}"
+
+    def net_args(self, tap_device, mac):
+        netdev = f"tap,id=mynet0,ifname={tap_device},script=no,downscript=no"
+        device = f"{self.nic},netdev=mynet0,mac={mac}"
+        if self.vhost:
+            netdev += ",vhost=on"
+        if self.queues:
+            netdev += f",queues={self.queues}"
+            # A vector per rx and tx queue plus config and control
+            device += f",mq=on,vectors={2 * self.queues + 2}"
+        return f"-netdev {netdev} -device {device}"
+
+    def label(self):
+        changed = [f"{f.name}={getattr(self, f.name)}" for f in fields(self) if getattr(self, f.name) != f.default]
+        return " ".join(changed) or "default"
+
+DEFAULT_QEMU_CONFIG = QemuConfig()
+
+@dataclass(frozen=True)
+class QmpConfig:
+    """Snapshot and resource sampling settings of a realm, both need a QMP connection
+
+    A missing `snapshot` file is saved by a cold boot at the `snapshot_at`
+    serial console event. Guest resources are sampled every
+    `stats_interval` seconds, keeping the latest `stats_capacity` samples.
+    """
+    snapshot: str = None
+    snapshot_at: str = "init_started"
+    stats_interval: float = None
+    stats_capacity: int = 600
+
+    def enabled(self):
+        return self.snapshot is not None or bool(self.stats_interval)
+
+DEFAULT_QMP_CONFIG = QmpConfig()
+
+def parse_qemu_config(value, base = DEFAULT_QEMU_CONFIG):
+    """Parses `smp=4,thread=multi,tb-size=512` into a QemuConfig based on `base`"""
+    def flag(v):
+        return v.lower() in ("1", "on", "yes", "true")
+
+    types = {f.name: int if f.name in ("smp", "memory", "tb_size", "queues") else str for f in fields(QemuConfig)}
+    types["iothread"] = types["vhost"] = flag
+    changes = {}
+    for item in value.split(","):
+        name, _, v = item.partition("=")
+        name = name.strip().replace("-", "_")
+        if name not in types:
+            raise argparse.ArgumentTypeError(f"Unknown QEMU option {name}, use one of {', '.join(types)}")
+        changes[name] = types[name](v)
+    return replace(base, **changes)
+
+def run_qemu(kernel, disk, tap_device, mac, guest_cid, qemu_serial, extra_args = [], config = DEFAULT_QEMU_CONFIG):
+    return subprocess.Popen(shlex.split(f"""
+ "../tools/qemu/build/qemu-system-aarch64" \
+        -machine virt \
+        -accel {config.accel_arg()} \
+        -cpu {config.cpu} \
+        -nographic -smp {config.smp} \
+        -kernel {kernel} \
+        -append "console=ttyAMA0" \
+        -m {config.memory} {config.disk_args(disk)}  {config.net_args(tap_device, mac)} \
+        -device vhost-vsock-pci,id=vhost-vsock-pci0,guest-cid={guest_cid} \
+        -serial {qemu_serial}
+                                                 """) + extra_args, stdin=-1, stdout=-1)
+
+class QmpClient():
+    """Minimal blocking client of QEMU's machine protocol"""
+
+    def __init__(self, path, timeout = 10):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        self.file = self.sock.makefile("rwb")
+        self.lock = threading.Lock()
+        self._read()
+        self.execute("qmp_capabilities")
+
+    def _read(self):
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("QMP connection closed")
+            msg = json.loads(line)
+            # Asynchronous events are not used
+            if "event" not in msg:
+                return msg
+
+    def execute(self, command, **arguments):
+        req = {"execute": command}
+        if arguments:
+            req["arguments"] = arguments
+        with self.lock:
+            self.file.write(json.dumps(req).encode() + b"\n")
+            self.file.flush()
+            r = self._read()
+
+        if "error" in r:
+            raise RuntimeError(f"QMP {command} failed: {r['error']['desc']}")
+        return r["return"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class QemuStats():
+    """Samples guest resource use over QMP into a ring buffer
+
+    Every sample holds the CPU time of each vCPU thread (read from /proc with
+    the thread ids of `query-cpus-fast`), guest memory, block device counters
+    and `query-stats`, which only returns data with KVM. Commands QEMU does
+    not know are left out of the following samples.
+    """
+
+    QUERIES = [
+        ("cpus", "query-cpus-fast", {}),
+        ("memory", "query-memory-size-summary", {}),
+        ("blockstats", "query-blockstats", {}),
+        ("stats", "query-stats", {"target": "vm"}),
+    ]
+
+    def __init__(self, qmp, interval = 1.0, capacity = 600):
+        self.qmp = qmp
+        self.interval = interval
+        self.samples = collections.deque(maxlen=capacity)
+        self.unsupported = set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def thread_cpu_time(tid):
+        try:
+            with open(f"/proc/{tid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime, fields 14 and 15 of proc_pid_stat(5)
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def sample(self):
+        s = {"time": time.time()}
+        for key, command, arguments in self.QUERIES:
+            if command in self.unsupported:
+                continue
+            try:
+                s[key] = self.qmp.execute(command, **arguments)
+            except RuntimeError:
+                self.unsupported.add(command)
+
+        for cpu in s.get("cpus", []):
+            cpu["cpu_time"] = self.thread_cpu_time(cpu["thread-id"])
+        self.samples.append(s)
+        return s
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except (OSError, ValueError):
+                # QEMU exited
+                return
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def get(self, last = None):
+        samples = list(self.samples)
+        return samples if last is None else samples[-last:]
+
+    @staticmethod
+    def summary(sample, previous = None):
+        parts = [time.strftime("%H:%M:%S", time.localtime(sample["time"]))]
+
+        cpus = sample.get("cpus", [])
+        if previous is not None and cpus:
+            dt = sample["time"] - previous["time"]
+            before = {c["cpu-index"]: c["cpu_time"] for c in previous.get("cpus", [])}
+            use = [(c["cpu_time"] - before[c["cpu-index"]]) / dt * 100 for c in cpus
+                   if c["cpu_time"] is not None and before.get(c["cpu-index"]) is not None]
+            parts.append("vcpu " + " ".join(f"{u:.0f}%" for u in use))
+        elif cpus:
+            parts.append(f"{len(cpus)} vcpus")
+
+        if "memory" in sample:
+            parts.append(f"memory {sample['memory']['base-memory'] >> 20} MiB")
+
+        for dev in sample.get("blockstats", []):
+            st = dev["stats"]
+            parts.append(f"{dev.get('device') or dev.get('qdev')} read {st['rd_bytes']} B/{st['rd_operations']} ops written {st['wr_bytes']} B/{st['wr_operations']} ops")
+
+        for provider in sample.get("stats", []):
+            for stat in provider["stats"]:
+                parts.append(f"{stat['name']} {stat['value']}")
+
+        return ", ".join(parts)
+
+def run_fake_realm(unix_socket, instances = 1, extra_args = ""):
+    """Starts fake_realm.py in place of QEMU, it connects to `unix_socket`"""
+    return subprocess.Popen([sys.executable, FAKE_REALM, "--unix", unix_socket, "--instances", str(instances)] + shlex.split(extra_args))
+
+def listen_unix(path, backlog = 1):
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+class LatencyHistogram():
+    """Log-linear histogram in the spirit of HdrHistogram
+
+    Values are bucketed with `significant_bits` bits of precision (under 1%
+    error for the default), so recording is O(1) and memory stays small no
+    matter how many samples are taken.
+    """
+
+    def __init__(self, significant_bits = 7):
+        self.significant_bits = significant_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        shift = max(value.bit_length() - self.significant_bits, 0)
+        bucket = (shift, value >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def buckets(self):
+        """Yields (highest value in bucket, count) pairs in ascending order"""
+        for shift, sub in sorted(self.counts.keys()):
+            yield min(((sub + 1) << shift) - 1, self.max), self.counts[(shift, sub)]
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = max(1, round(self.count * p / 100))
+        seen = 0
+        for value, count in self.buckets():
+            seen += count
+            if seen >= target:
+                return value
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min_ns": self.min or 0,
+            "mean_ns": self.total // self.count if self.count else 0,
+            "p50_ns": self.percentile(50),
+            "p90_ns": self.percentile(90),
+            "p99_ns": self.percentile(99),
+            "max_ns": self.max,
+            "buckets": list(self.buckets()),
+        }
+
+SERIAL_MARKERS = [
+    ("kernel_started", re.compile(r"Booting Linux on physical CPU")),
+    ("init_started", re.compile(r"Run /init as init process")),
+    ("dhcp_started", re.compile(r"udhcpc: started")),
+    ("dhcp_lease", re.compile(r"udhcpc: lease of")),
+    ("app_manager_started", re.compile(r"Reading config file")),
+    ("connected", re.compile(r"Connected to warden daemon")),
+    ("installation_started", re.compile(r"Starting installation")),
+    ("image_fetching", re.compile(r"Fetching image info for")),
+    ("image_unpacked", re.compile(r"Installation finished, moving")),
+    ("crypt_created", re.compile(r"Creating device crypt_(\S+)")),
+    ("crypt_resumed", re.compile(r"Resuming device crypt_(\S+)")),
+    ("fs_mounted", re.compile(r"EXT4-fs \((dm-\d+)\): mounted filesystem")),
+    ("overlay_mounting", re.compile(r"Mounting overlayfs")),
+    ("installed", re.compile(r"Finished installing (\S+)")),
+    ("measuring", re.compile(r"Measuring app (\S+)")),
+    ("app_starting", re.compile(r"Starting app (\S+)")),
+    ("provisioned", re.compile(r"Provisioning finished")),
+    ("apps_started", re.compile(r"Applications started entering event loop")),
+]
+
+# Events a snapshot can be taken at. A restored guest's vsock connections
+# are reset and app-manager does not reconnect, so it has to be taken
+# before app-manager connects.
+SNAPSHOT_EVENTS = ["kernel_started", "init_started", "dhcp_started", "dhcp_lease", "app_manager_started"]
+
+# (phase, first event, last event), measured from the first occurrence of each
+SERIAL_PHASES = [
+    ("kernel_boot", "launch", "init_started"),
+    ("userspace_init", "init_started", "dhcp_started"),
+    ("dhcp", "dhcp_started", "dhcp_lease"),
+    ("app_manager_connect", "app_manager_started", "connected"),
+    ("installation", "installation_started", "provisioned"),
+    ("oci_pull", "image_fetching", "image_unpacked"),
+    ("app_start", "provisioned", "apps_started"),
+]
+
+KERNEL_TIMESTAMP = re.compile(r"^\[\s*(\d+\.\d+)\]")
+
+class SerialTimeline():
+    """Builds per boot phase timelines out of the realm's serial console
+
+    Every line is stamped with the host time it arrived at since the clocks
+    of the kernel and app-manager log lines are not comparable. The guest
+    kernel timestamp is kept alongside when the line has one.
+    """
+
+    def __init__(self):
+        self.boots = []
+        self.lock = threading.Condition()
+
+    def new_boot(self, launch = None):
+        with self.lock:
+            self.boots.append({"launch": launch if launch is not None else time.perf_counter(), "events": []})
+
+    def feed(self, line, now = None):
+        now = now if now is not None else time.perf_counter()
+        guest_time = KERNEL_TIMESTAMP.match(line)
+        guest_time = float(guest_time.group(1)) if guest_time else None
+
+        for event, pattern in SERIAL_MARKERS:
+            m = pattern.search(line)
+            if m is None:
+                continue
+
+            with self.lock:
+                # A reboot that was not started by run_qemu
+                if event == "kernel_started" and (not self.boots or self.boots[-1]["events"]):
+                    self.boots.append({"launch": now, "events": []})
+                if not self.boots:
+                    self.boots.append({"launch": now, "events": []})
+
+                boot = self.boots[-1]
+                boot["events"].append({
+                    "event": event,
+                    "t": now - boot["launch"],
+                    "guest_time": guest_time,
+                    "arg": m.group(1) if m.groups() else None,
+                    "line": line,
+                })
+                self.lock.notify_all()
+
+    def wait_for_event(self, event, timeout = None):
+        """Waits until `event` shows up in the current boot"""
+        with self.lock:
+            return self.lock.wait_for(lambda: self.boots and any(e["event"] == event for e in self.boots[-1]["events"]), timeout)
+
+    @staticmethod
+    def phases(boot):
+        first = {"launch": 0.0}
+        for e in boot["events"]:
+            first.setdefault(e["event"], e["t"])
+
+        phases = {}
+        for name, start, end in SERIAL_PHASES:
+            if start in first and end in first:
+                phases[name] = first[end] - first[start]
+
+        # Devices are set up concurrently for many apps, so these are summed per device
+        created = {}
+        resumed = []
+        dm_crypt = mkfs_mount = 0.0
+        for e in boot["events"]:
+            if e["event"] == "crypt_created":
+                created[e["arg"]] = e["t"]
+            elif e["event"] == "crypt_resumed" and e["arg"] in created:
+                dm_crypt += e["t"] - created.pop(e["arg"])
+                resumed.append(e["t"])
+            elif e["event"] == "fs_mounted" and resumed:
+                mkfs_mount += e["t"] - resumed.pop(0)
+
+        if dm_crypt:
+            phases["dm_crypt"] = dm_crypt
+        if mkfs_mount:
+            phases["mkfs_mount"] = mkfs_mount
+
+        return phases
+
+    @staticmethod
+    def provisioning(boot):
+        """Splits provisioning into the concurrent installation, the serial measurement loop and app starts"""
+        events = boot["events"]
+        first = {}
+        for e in events:
+            first.setdefault(e["event"], e["t"])
+        if "installation_started" not in first or "provisioned" not in first:
+            return None
+
+        start = first["installation_started"]
+        installed = [e["t"] - start for e in events if e["event"] == "installed"]
+        measured = first.get("measuring", first["provisioned"])
+        starting = first.get("app_starting", first["provisioned"])
+        return {
+            "install": max(installed, default=0.0),
+            "per_app_install": installed,
+            "measure": starting - measured,
+            "start": first["provisioned"] - starting,
+        }
+
+    def to_json(self):
+        with self.lock:
+            return [{"phases": self.phases(b), "events": b["events"]} for b in self.boots]
+
+    def summary(self):
+        for i, boot in enumerate(self.to_json()):
+            print(f"Boot {i}:")
+            for name, took in boot["phases"].items():
+                print(f"  {name:20} {took:8.3f}s")
+            if boot["events"]:
+                print(f"  {'total':20} {boot['events'][-1]['t']:8.3f}s")
+
+class SerialCapture():
+    """Receives the serial console of QEMU over a unix socket"""
+
+    def __init__(self, path, log = None):
+        self.path = path
+        self.log = open(log, "a") if log else None
+        self.timeline = SerialTimeline()
+        self.sock = listen_unix(path)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def qemu_serial(self):
+        return f"unix:{self.path}"
+
+    def _run(self):
+        # QEMU connects again every time it is launched
+        while True:
+            conn, _ = self.sock.accept()
+            with conn, conn.makefile("r", encoding="utf-8", errors="replace", newline="") as f:
+                for line in f:
+                    line = line.rstrip("\r\n")
+                    self.timeline.feed(line)
+                    if self.log:
+                        self.log.write(line + "\n")
+                        self.log.flush()
+
+    def report(self, output = None):
+        self.timeline.summary()
+        if output:
+            with open(output, "w") as f:
+                json.dump(self.timeline.to_json(), f, indent=2)
+            print(f"Boot timeline written to {output}")
+
+class StdlibJsonCodec():
+    """Frame payloads with the json module, decoded from the buffer without a bytes copy"""
+
+    name = "json"
+
+    def encode(self, obj, default = None):
+        return json.dumps(obj, separators=(",", ":"), default=default).encode()
+
+    def decode(self, buf):
+        return json.loads(str(buf, "utf-8"))
+
+class OrjsonCodec():
+    """Frame payloads with orjson, which encodes straight to bytes and parses a memoryview in place"""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+    def encode(self, obj, default = None):
+        return self.dumps(obj, default=default)
+
+    def decode(self, buf):
+        return self.loads(buf)
+
+JSON_CODECS = {"json": StdlibJsonCodec, "orjson": OrjsonCodec}
+
+def json_codec(name = "auto"):
+    """Returns the codec called `name`, `auto` is orjson when it is installed and json otherwise
+
+    orjson takes a while to import, so it is only loaded once a codec is needed.
+    """
+    if name != "auto":
+        return JSON_CODECS[name]()
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        return StdlibJsonCodec()
+
+# Buffers a single sendmsg call accepts
+IOV_MAX = os.sysconf("SC_IOV_MAX")
+# Smaller frames are cheaper to copy behind their header than to hand to
+# sendmsg as two more iovecs
+GATHER_MIN_FRAME_SIZE = 16 * 1024
+
+def send_buffers(conn, buffers):
+    """sendall for a list of buffers, they are gathered by sendmsg instead of being joined first
+
+    Returns the number of bytes sent.
+    """
+    total = sum(map(len, buffers))
+    sent = conn.sendmsg(buffers) if len(buffers) <= IOV_MAX else 0
+    if sent == total:
+        return total
+
+    # Partial send, continue after the last byte that went out
+    buffers = [memoryview(b).cast("B") for b in buffers]
+    i = 0
+    while True:
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        if i == len(buffers):
+            return total
+        if sent:
+            buffers[i] = buffers[i][sent:]
+        sent = conn.sendmsg(buffers[i:i + IOV_MAX])
+
+def send_frames(conn, payloads, headers):
+    """Sends `payloads` as `>I` length prefixed frames in one go and returns the bytes sent
+
+    Large payloads are not copied, their headers are packed into `headers`,
+    a reusable buffer of at least 4 bytes per payload, and sent next to them
+    with sendmsg.
+    """
+    size = sum(map(len, payloads))
+    if size >= GATHER_MIN_FRAME_SIZE * len(payloads):
+        view = memoryview(headers)
+        buffers = []
+        for i, s in enumerate(payloads):
+            struct.pack_into(">I", headers, 4 * i, len(s))
+            buffers += [view[4 * i:4 * i + 4], s]
+        return send_buffers(conn, buffers)
+
+    if len(payloads) == 1:
+        data = struct.pack(">I", size) + payloads[0]
+    else:
+        data = bytearray()
+        for s in payloads:
+            data += struct.pack(">I", len(s))
+            data += s
+    conn.sendall(data)
+    return len(data)
+
+class FrameReader():
+    """Reads whole `>I` length prefixed frames into a single reusable buffer"""
+
+    def __init__(self, max_frame_size = MAX_FRAME_SIZE, initial_size = 64 * 1024):
+        self.max_frame_size = max_frame_size
+        self.buf = bytearray(min(initial_size, max_frame_size))
+        self.view = memoryview(self.buf)
+        self.bytes_received = 0
+
+    def _reserve(self, n):
+        if n > len(self.buf):
+            size = len(self.buf) or 1
+            while size < n:
+                size *= 2
+            self.buf = bytearray(min(size, self.max_frame_size))
+            self.view = memoryview(self.buf)
+
+    def recv_exact(self, conn, n):
+        self._reserve(n)
+        pos = 0
+        while pos < n:
+            r = conn.recv_into(self.view[pos:n], n - pos)
+            if r == 0:
+                raise ConnectionError(f"Connection closed after {pos} of {n} bytes")
+            pos += r
+
+        self.bytes_received += n
+        return self.view[:n]
+
+    def read_frame(self, conn):
+        l = struct.unpack(">I", self.recv_exact(conn, 4))[0]
+        if l > self.max_frame_size:
+            raise ValueError(f"Frame of {l} bytes exceeds the limit of {self.max_frame_size} bytes")
+
+        # The returned view is only valid until the next read
+        return self.recv_exact(conn, l)
+
+@dataclass()
+class StatusChange:
+    id: str
+    old: str
+    new: str
+    response: dict
+    time: float
+
+class StatusWatcher():
+    """Polls CheckStatus for a set of applications and reports status changes
+
+    All applications are polled with one pipelined write. The interval grows
+    by `backoff` up to `max_interval` while nothing changes and drops back to
+    `min_interval` after every change, idle applications cost few requests
+    while exits right after a start are noticed quickly.
+
+    Changes are passed to the on_change() callbacks and yielded by changes(),
+    or by `async for` which polls from a worker thread.
+    """
+
+    def __init__(self, host, ids, min_interval = 0.01, max_interval = 0.5, backoff = 2.0, window = 16):
+        self.host = host
+        self.ids = [str(id) for id in ids]
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.window = window
+        self.interval = min_interval
+        self.status = {}
+        self.responses = {}
+        self.callbacks = []
+        self.polls = 0
+
+    def on_change(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def poll(self):
+        responses = self.host.check_apps(self.ids, self.window)
+        self.polls += 1
+        now = time.time()
+
+        changes = []
+        for id, r in zip(self.ids, responses):
+            new = next(iter(r))
+            self.responses[id] = r
+            if new != self.status.get(id):
+                changes.append(StatusChange(id, self.status.get(id), new, r, now))
+                self.status[id] = new
+
+        if changes:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+        for change in changes:
+            for callback in self.callbacks:
+                callback(change)
+        return changes
+
+    def changes(self, timeout = None):
+        """Yields changes until `timeout` runs out, the first poll reports every application"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            yield from self.poll()
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+
+    async def __aiter__(self):
+        import asyncio
+        while True:
+            for change in await asyncio.to_thread(self.poll):
+                yield change
+            await asyncio.sleep(self.interval)
+
+    def wait_for(self, status, timeout = None):
+        """Returns the responses once every application reports `status`, raises TimeoutError otherwise"""
+        for _ in self.changes(timeout):
+            if len(self.status) == len(self.ids) and all(s == status for s in self.status.values()):
+                return dict(self.responses)
+        raise TimeoutError(f"Applications did not reach {status} in {timeout}s, last status {self.responses}")
+
 class MockedWarden():
-    def __init__(self, kernel, vsock_port = 1337, guest_cid = 1227, tap_device = "tap100", qemu_serial = "tcp:localhost:1337"):
+    def __init__(self, kernel, vsock_port = 1337, guest_cid = 1227, tap_device = "tap100", qemu_serial = "tcp:localhost:1337",
+                 max_frame_size = MAX_FRAME_SIZE, mac = DEFAULT_MAC, disk = "disk.raw", disk_clone = "auto", serial_capture = None,
+                 fake_realm = None, unix_socket = "warden.sock", qemu_config = DEFAULT_QEMU_CONFIG, qmp_config = DEFAULT_QMP_CONFIG,
+                 layout = DEFAULT_LAYOUT, codec = "auto"):
         self.vsock_port = vsock_port
         self.guest_cid = guest_cid
         self.tap_device = tap_device
         self.qemu_serial = qemu_serial
-        self.sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM, 0)
-        self.sock.bind((socket.VMADDR_CID_ANY, vsock_port))
-        self.sock.listen(1)
+        self.mac = mac
+        self.disk = disk
+        self.disk_clone = disk_clone
+        self.serial_capture = serial_capture
+        if serial_capture is not None:
+            self.qemu_serial = serial_capture.qemu_serial()
+        self.fake_realm = fake_realm
+        self.unix_socket = unix_socket
+        if fake_realm is not None:
+            self.sock = listen_unix(unix_socket)
+        else:
+            self.sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM, 0)
+            self.sock.bind((socket.VMADDR_CID_ANY, vsock_port))
+            self.sock.listen(1)
         self.kernel = kernel
+        self.reader = FrameReader(max_frame_size)
+        self.codec = json_codec(codec)
+        # Frame headers are packed in place and sent next to their payloads
+        self.headers = bytearray(4)
+        self.bytes_sent = 0
+        self.qmp_config = qmp_config
+        self.qmp_socket = f"qmp-{guest_cid}.sock"
+        self.qmp = self.sampler = None
+        self.qemu_config = qemu_config
+        self.layout = layout
+        self.launched = self.connected = None
+        self.paused = 0.0
 
     def prepare_disk(self):
-        if not os.path.isfile("disk.raw"):
-            disk = Disk("disk.raw")
-            disk.create(1024 * 1024 * 1024)
-
-            image_part = Partition("image", 256 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value, partition_guid=IMAGE_UUID)
-            data_part = Partition("data", 256 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value, partition_guid=DATA_UUID)
+        if self.fake_realm is not None:
+            return
+        self.disk = prepare_disk(self.disk, self.layout, method=self.disk_clone)
 
-            disk.table.partitions.add(image_part)
-            disk.table.partitions.add(data_part)
-            disk.commit()
+    def remove_disk(self):
+        """Drops the realm disk, the next start() clones a fresh one from the template"""
+        if self.fake_realm is None and os.path.isfile(self.disk):
+            os.unlink(self.disk)
 
     def run_qemu(self):
-        self.qemu = subprocess.Popen(shlex.split(f"""
- "../tools/qemu/build/qemu-system-aarch64" \
-        -machine virt \
-        -cpu cortex-a57 \
-        -nographic -smp 1 \
-        -kernel {self.kernel} \
-        -append "console=ttyAMA0" \
-        -m 2048 -drive file=disk.raw  -netdev tap,id=mynet0,ifname={self.tap_device},script=no,downscript=no -device e1000,netdev=mynet0,mac=52:55:00:d1:55:01 \
-        -device vhost-vsock-pci,id=vhost-vsock-pci0,guest-cid={self.guest_cid} \
-        -serial {self.qemu_serial}
-                                                 """), stdin=-1, stdout=-1)
+        if self.fake_realm is not None:
+            self.qemu = run_fake_realm(self.unix_socket, 1, self.fake_realm)
+            return
+        if self.serial_capture is not None:
+            self.serial_capture.timeline.new_boot()
+
+        config = self.qmp_config
+        extra_args = []
+        if config.enabled():
+            extra_args += ["-qmp", f"unix:{self.qmp_socket},server=on,wait=off"]
+        if config.snapshot is not None and os.path.isfile(config.snapshot):
+            extra_args += ["-incoming", f"exec:cat {shlex.quote(config.snapshot)}"]
+
+        self.launched = time.perf_counter()
+        self.paused = 0.0
+        self.qemu = run_qemu(self.kernel, self.disk, self.tap_device, self.mac, self.guest_cid, self.qemu_serial, extra_args, self.qemu_config)
+
+        if config.enabled():
+            self.close_qmp()
+            self.qmp = QmpClient(self.qmp_socket)
+        if config.stats_interval:
+            self.sampler = QemuStats(self.qmp, config.stats_interval, config.stats_capacity)
+
+    def close_qmp(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.qmp is not None:
+            self.qmp.close()
+        self.qmp = self.sampler = None
+
+    def stats(self, last = None):
+        """Returns the latest `last` resource samples, all when it is None"""
+        if self.sampler is None:
+            return []
+        return self.sampler.get(last)
 
-    def start(self):
+    def start(self, fresh_disk = False):
+        snapshot, snapshot_at = self.qmp_config.snapshot, self.qmp_config.snapshot_at
+        # A restored VM expects the disk it was saved with
+        if fresh_disk or snapshot is not None:
+            self.remove_disk()
         self.prepare_disk()
+        restored = snapshot is not None and os.path.isfile(snapshot)
         self.run_qemu()
-        self.reconnect()
 
-    def transaction(self, req, read_resp = True):
-        s = json.dumps(req)
-        l = struct.pack(">I", len(s))
-        data = l + s.encode()
+        if restored:
+            self.resume_snapshot()
+        elif snapshot is not None:
+            if not self.serial_capture.timeline.wait_for_event(snapshot_at, timeout=600):
+                raise TimeoutError(f"Realm did not reach {snapshot_at}")
+            self.save_snapshot()
+
+        # A resumed guest that never connects would leave accept() waiting forever
+        self.reconnect(timeout=60 if restored else None)
+
+        if snapshot is not None:
+            self.report_boot(restored)
+
+    def save_snapshot(self):
+        """Saves the VM state with a migration to file, then lets the VM continue"""
+        qmp = self.qmp
+        snapshot = self.qmp_config.snapshot
+        start = time.perf_counter()
+        tmp = f"{snapshot}.tmp"
+
+        qmp.execute("stop")
+        qmp.execute("migrate", uri=f"exec:cat > {shlex.quote(tmp)}")
+        while True:
+            status = qmp.execute("query-migrate").get("status")
+            if status in ("completed", "failed", "cancelled"):
+                break
+            time.sleep(0.05)
+        if status != "completed":
+            raise RuntimeError(f"Saving VM state failed with migration status {status}")
+
+        os.replace(tmp, snapshot)
+        qmp.execute("cont")
 
-        self.conn.sendall(data)
+        self.paused += time.perf_counter() - start
+        print(f"Saved VM state at {self.qmp_config.snapshot_at} to {snapshot} in {self.paused:.3f}s")
+
+    def resume_snapshot(self, timeout = 600):
+        """Waits until QEMU loaded the -incoming VM state and resumes the VM
+
+        The state is saved after `stop`, so QEMU restores the VM paused.
+        """
+        qmp = self.qmp
+        snapshot = self.qmp_config.snapshot
+        deadline = time.monotonic() + timeout
+        while (status := qmp.execute("query-status")["status"]) == "inmigrate":
+            if self.qemu.poll() is not None:
+                raise RuntimeError(f"QEMU exited with {self.qemu.returncode} while loading {snapshot}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Loading {snapshot} took longer than {timeout}s")
+            time.sleep(0.01)
+
+        if status != "running":
+            qmp.execute("cont")
+        status = qmp.execute("query-status")
+        if not status["running"]:
+            raise RuntimeError(f"Restored VM did not resume, its status is {status['status']}")
+
+    def report_boot(self, restored):
+        latency = self.connected - self.launched - self.paused
+        info = f"{self.qmp_config.snapshot}.json"
+
+        if restored:
+            cold = None
+            if os.path.isfile(info):
+                with open(info) as f:
+                    cold = json.load(f).get("cold_boot_to_connect")
+            print(f"Restored realm connected {latency:.3f}s after launch, cold boot took {cold:.3f}s" if cold else f"Restored realm connected {latency:.3f}s after launch")
+        else:
+            with open(info, "w") as f:
+                json.dump({"cold_boot_to_connect": latency, "snapshot_at": self.qmp_config.snapshot_at}, f)
+            print(f"Cold booted realm connected {latency:.3f}s after launch, not counting the snapshot")
+
+    def transaction(self, req, read_resp = True):
+        self.bytes_sent += send_frames(self.conn, [self.codec.encode(req)], self.headers)
 
         if read_resp:
-            l = self.conn.recv(4)
-            l = struct.unpack(">I", l)[0]
-            resp = self.conn.recv(l)
-            return json.loads(resp.decode())
+            return self.codec.decode(self.reader.read_frame(self.conn))
+
+    def transaction_many(self, reqs, window = 16):
+        """Pipelines `reqs` and returns their responses in order
+
+        Up to `window` frames are written with a single send before their
+        responses are read back. Bounding the window keeps both socket
+        buffers from filling up and deadlocking on large batches.
+        """
+        if window < 1:
+            raise ValueError(f"Pipeline window has to be at least 1, got {window}")
+        resps = []
+        if len(self.headers) < 4 * min(window, len(reqs)):
+            self.headers = bytearray(4 * min(window, len(reqs)))
+        for i in range(0, len(reqs), window):
+            batch = reqs[i:i + window]
+            self.bytes_sent += send_frames(self.conn, [self.codec.encode(req) for req in batch], self.headers)
+
+            for _ in batch:
+                resps.append(self.codec.decode(self.reader.read_frame(self.conn)))
+
+        return resps
 
     def provision(self, apps: List[App]):
         o = {"ProvisionInfo": [i.__dict__ for i in apps]}
         return self.transaction(o)
 
+    def check_apps(self, ids, window = 16):
+        return self.transaction_many([{"CheckStatus": str(id)} for id in ids], window)
+
+    def watch_apps(self, ids, **kwargs):
+        return StatusWatcher(self, ids, **kwargs)
+
     def start_app(self, id=APP_ID):
         o = {"StartApp": str(id)}
         return self.transaction(o)
@@ -101,10 +1354,21 @@ class MockedWarden():
         o = {"CheckStatus": str(id)}
         return self.transaction(o)
 
+    def get_attestation_token(self, challenge = None):
+        """Returns the token as bytes, or the error response when there is none"""
+        if challenge is None:
+            challenge = os.urandom(64)
+        o = {"GetAttestationToken": list(challenge)}
+        r = self.transaction(o)
+        if "AttestationToken" in r:
+            return bytes(r["AttestationToken"])
+        return r
+
     def shutdown(self):
         o = {"Shutdown": []}
         self.transaction(o, read_resp=False)
         self.qemu.communicate()
+        self.close_qmp()
 
     def reboot(self):
         o = {"Reboot": []}
@@ -131,9 +1395,16 @@ class MockedWarden():
         ])
         return r
 
-    def reconnect(self):
+    def reconnect(self, timeout = None):
         print(f"Waiting for connection from realm")
-        self.conn, self.addr = self.sock.accept()
+        self.sock.settimeout(timeout)
+        try:
+            self.conn, self.addr = self.sock.accept()
+        except socket.timeout:
+            raise TimeoutError(f"Realm did not connect within {timeout}s") from None
+        finally:
+            self.sock.settimeout(None)
+        self.connected = time.perf_counter()
         print(f"Accepted connection from {self.addr}")
 
     def wait_for_qemu(self):
@@ -147,19 +1418,711 @@ class MockedWarden():
 
         return r
 
+class AsyncMockedWarden():
+    """Serves many app-manager connections on one listening socket
 
-def main():
-    main_parser = argparse.ArgumentParser()
-    main_parser.add_argument("--vsock_port", type=int, default=1337)
-    main_parser.add_argument("--guest-cid", type=int, default=1337)
-    main_parser.add_argument("--tap-device", type=str, default="tap100")
-    main_parser.add_argument("--qemu-serial", type=str, default="tcp:localhost:1337")
-    main_parser.add_argument('--kernel', type=str, default='../linux/arch/arm64/boot/Image')
-    main_parser.add_argument("--test", action='store_true', default=False)
-    main_parser.add_argument("--use-oci", type=str, help="Image registry url", required=False)
-    args = main_parser.parse_args()
+    Realms are keyed by the peer CID returned from accept. Stand-in peers on
+    other socket families (AF_UNIX, loopback) are keyed by their peer address,
+    or by connection order when they have none.
+    """
+
+    def __init__(self, vsock_port = 1337, sock = None, max_frame_size = MAX_FRAME_SIZE, codec = "auto"):
+        if sock is None:
+            sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM, 0)
+            sock.bind((socket.VMADDR_CID_ANY, vsock_port))
+            sock.listen(socket.SOMAXCONN)
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self.codec = json_codec(codec)
+        self.realms = {}
+        self.locks = {}
+        self.connected = None
+        self.server = None
+        self.anonymous_peers = itertools.count()
+
+    def peer_key(self, addr):
+        if self.sock.family == socket.AF_VSOCK:
+            return addr[0]
+        if addr:
+            return addr
+        return next(self.anonymous_peers)
+
+    async def start(self):
+        import asyncio
+        self.connected = asyncio.Condition()
+        self.server = await asyncio.start_server(self._accept, sock=self.sock, backlog=socket.SOMAXCONN)
+
+    async def _accept(self, reader, writer):
+        import asyncio
+        key = self.peer_key(writer.get_extra_info("peername"))
+        print(f"Accepted connection from {key}")
+
+        old = self.realms.get(key)
+        if old is not None:
+            old[1].close()
+
+        async with self.connected:
+            self.realms[key] = (reader, writer)
+            self.locks[key] = asyncio.Lock()
+            self.connected.notify_all()
+
+    async def wait_for_realm(self, key):
+        async with self.connected:
+            await self.connected.wait_for(lambda: key in self.realms)
+
+    def peer_pid(self, key):
+        """Process id of a peer connected over AF_UNIX"""
+        sock = self.realms[key][1].get_extra_info("socket")
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        return struct.unpack("3i", creds)[0]
+
+    async def wait_for_unclaimed_realm(self, claimed, pid = None):
+        """Waits for a connected realm not in `claimed`, optionally from process `pid`, and adds it there"""
+        def unclaimed():
+            return [key for key in self.realms if key not in claimed and (pid is None or self.peer_pid(key) == pid)]
+
+        async with self.connected:
+            await self.connected.wait_for(unclaimed)
+            key = unclaimed()[0]
+        claimed.add(key)
+        return key
+
+    async def wait_for_realms(self, count):
+        async with self.connected:
+            await self.connected.wait_for(lambda: len(self.realms) >= count)
+        return list(self.realms.keys())
+
+    def disconnect(self, key):
+        _, writer = self.realms.pop(key)
+        self.locks.pop(key)
+        writer.close()
+
+    async def close(self):
+        for key in list(self.realms.keys()):
+            self.disconnect(key)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def transaction(self, key, req, read_resp = True):
+        reader, writer = self.realms[key]
+        s = self.codec.encode(req)
+
+        # Responses come back in request order, so only one request may be in flight per realm
+        async with self.locks[key]:
+            writer.writelines([struct.pack(">I", len(s)), s])
+            await writer.drain()
+
+            if read_resp:
+                l = struct.unpack(">I", await reader.readexactly(4))[0]
+                if l > self.max_frame_size:
+                    raise ValueError(f"Frame of {l} bytes exceeds the limit of {self.max_frame_size} bytes")
+                return self.codec.decode(await reader.readexactly(l))
+
+    async def provision(self, key, apps: List[App]):
+        o = {"ProvisionInfo": [i.__dict__ for i in apps]}
+        return await self.transaction(key, o)
+
+    async def start_app(self, key, id=APP_ID):
+        o = {"StartApp": str(id)}
+        return await self.transaction(key, o)
+
+    async def stop_app(self, key, id=APP_ID):
+        o = {"StopApp": str(id)}
+        return await self.transaction(key, o)
+
+    async def kill_app(self, key, id=APP_ID):
+        o = {"KillApp": str(id)}
+        return await self.transaction(key, o)
+
+    async def check_app(self, key, id=APP_ID):
+        o = {"CheckStatus": str(id)}
+        return await self.transaction(key, o)
+
+    async def get_attestation_token(self, key, challenge = None):
+        if challenge is None:
+            challenge = os.urandom(64)
+        o = {"GetAttestationToken": list(challenge)}
+        r = await self.transaction(key, o)
+        if "AttestationToken" in r:
+            return bytes(r["AttestationToken"])
+        return r
+
+    async def getifaddrs(self, key):
+        o = {"GetIfAddrs": []}
+        return await self.transaction(key, o)
+
+    async def reboot(self, key):
+        o = {"Reboot": []}
+        await self.transaction(key, o, read_resp=False)
+        self.disconnect(key)
+
+    async def shutdown(self, key):
+        o = {"Shutdown": []}
+        await self.transaction(key, o, read_resp=False)
+        self.disconnect(key)
+
+class RealmBootError(RuntimeError):
+    """A realm exited or timed out before connecting to the host"""
+
+async def wait_for_boot(waiter, process, timeout):
+    """Returns the result of `waiter`, the connection of a booting realm
+
+    Raises RealmBootError when `process` exits first or `timeout` seconds
+    pass, so a QEMU that fails to start does not leave the caller waiting
+    forever. The process is polled instead of waited on in a thread, every
+    realm would otherwise hold an executor thread for its whole lifetime.
+    """
+    import asyncio
+    task = asyncio.ensure_future(waiter)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=0.1)
+            if done:
+                return task.result()
+            if process.poll() is not None:
+                raise RealmBootError(f"exited with status {process.returncode} before connecting")
+            if time.monotonic() > deadline:
+                raise RealmBootError(f"did not connect within {timeout}s")
+    finally:
+        task.cancel()
+
+def describe_slot(slot, fake_realm):
+    if fake_realm is not None:
+        return f"Fake realm {slot.index}"
+    return f"Realm {slot.index} (cid {slot.guest_cid}, {slot.tap_device}, {slot.mac})"
+
+def stop_processes(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+class RealmFleet():
+    """Boots many realms at once and serves them from a single AsyncMockedWarden
+
+    With `fake_realm` set a single fake_realm.py process simulates all the
+    realms over a unix socket. Those realms are keyed by connection order
+    instead of their CID.
+    """
+
+    def __init__(self, kernel, count, vsock_port = 1337, guest_cid = 1337, tap_device = "tap100", max_frame_size = MAX_FRAME_SIZE, disk_clone = "auto", fake_realm = None, unix_socket = "warden.sock", qemu_config = DEFAULT_QEMU_CONFIG, codec = "auto", boot_timeout = 600):
+        self.kernel = kernel
+        self.qemu_config = qemu_config
+        self.boot_timeout = boot_timeout
+        self.disk_clone = disk_clone
+        self.fake_realm = fake_realm
+        self.unix_socket = unix_socket
+        self.slots = allocate_realms(count, guest_cid, tap_device)
+        sock = listen_unix(unix_socket, socket.SOMAXCONN) if fake_realm is not None else None
+        self.warden = AsyncMockedWarden(vsock_port, sock=sock, max_frame_size=max_frame_size, codec=codec)
+        self.qemus = {}
+        self.connect_latency = {}
+
+    def key(self, slot):
+        return slot.index if self.fake_realm is not None else slot.guest_cid
+
+    def keys(self):
+        return [self.key(slot) for slot in self.slots]
+
+    async def _wait_for_connection(self, slot, process, launched):
+        key = self.key(slot)
+        try:
+            await wait_for_boot(self.warden.wait_for_realm(key), process, self.boot_timeout)
+        except RealmBootError as e:
+            raise RealmBootError(f"{describe_slot(slot, self.fake_realm)} {e}") from None
+        self.connect_latency[key] = time.perf_counter() - launched
+
+    async def launch(self):
+        import asyncio
+        if self.fake_realm is None:
+            for slot in self.slots:
+                slot.disk = prepare_disk(slot.disk, method=self.disk_clone)
+
+        await self.warden.start()
+
+        waiters = []
+        if self.fake_realm is not None:
+            launched = time.perf_counter()
+            self.qemus["fake"] = run_fake_realm(self.unix_socket, len(self.slots), self.fake_realm)
+            waiters = [self._wait_for_connection(slot, self.qemus["fake"], launched) for slot in self.slots]
+        else:
+            for slot in self.slots:
+                launched = time.perf_counter()
+                self.qemus[slot.guest_cid] = run_qemu(self.kernel, slot.disk, slot.tap_device, slot.mac, slot.guest_cid, slot.qemu_serial, config=self.qemu_config)
+                waiters.append(self._wait_for_connection(slot, self.qemus[slot.guest_cid], launched))
+
+        print(f"Waiting for connection from {len(self.slots)} realms")
+        try:
+            await asyncio.gather(*waiters)
+        except RealmBootError:
+            stop_processes(self.qemus.values())
+            await self.warden.close()
+            raise
+
+    async def provision_all(self, apps: List[App]):
+        import asyncio
+        keys = self.keys()
+        results = await asyncio.gather(*[self.warden.provision(key, apps) for key in keys])
+        return dict(zip(keys, results))
+
+    async def shutdown(self):
+        import asyncio
+        await asyncio.gather(*[self.warden.shutdown(key) for key in self.keys()])
+        for qemu in self.qemus.values():
+            await asyncio.to_thread(qemu.communicate)
+        await self.warden.close()
+
+    def report(self):
+        for slot in self.slots:
+            latency = self.connect_latency[self.key(slot)]
+            print(f"{describe_slot(slot, self.fake_realm)}: connected {latency:.3f}s after launch")
+
+        latencies = sorted(self.connect_latency.values())
+        print(f"Boot to connect: min {latencies[0]:.3f}s, median {latencies[len(latencies) // 2]:.3f}s, max {latencies[-1]:.3f}s")
+
+@dataclass()
+class PooledRealm:
+    key: object
+    slot: RealmSlot
+    process: subprocess.Popen
+    boot_time: float
+
+class RealmPool():
+    """Keeps `size` realms booted and connected, but not provisioned
+
+    acquire() hands out a ready realm in O(1) and boots a replacement in the
+    background. Released realms are shut down and their slot (CID, tap, MAC,
+    disk) is booted again with a fresh disk clone.
+    """
+
+    def __init__(self, kernel, size, max_realms = None, vsock_port = 1337, guest_cid = 1337, tap_device = "tap100", max_frame_size = MAX_FRAME_SIZE, disk_clone = "auto", fake_realm = None, unix_socket = "warden.sock", qemu_config = DEFAULT_QEMU_CONFIG, codec = "auto", boot_timeout = 600):
+        self.kernel = kernel
+        self.qemu_config = qemu_config
+        self.boot_timeout = boot_timeout
+        self.size = size
+        self.disk_clone = disk_clone
+        self.fake_realm = fake_realm
+        self.unix_socket = unix_socket
+        self.free_slots = collections.deque(allocate_realms(max_realms or 2 * size, guest_cid, tap_device))
+        sock = listen_unix(unix_socket, socket.SOMAXCONN) if fake_realm is not None else None
+        self.warden = AsyncMockedWarden(vsock_port, sock=sock, max_frame_size=max_frame_size, codec=codec)
+        self.ready = collections.deque()
+        self.claimed = set()
+        self.booting = 0
+        self.processes = set()
+        self.failed = None
+        self.tasks = set()
+        self.changed = None
+        self.hits = 0
+        self.misses = 0
+        self.refill_latency = LatencyHistogram()
+
+    async def start(self):
+        import asyncio
+        self.changed = asyncio.Condition()
+        await self.warden.start()
+        self._refill()
+
+    async def wait_until_full(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.failed or len(self.ready) >= self.size or not (self.free_slots or self.booting))
+        if self.failed:
+            raise self.failed
+
+    async def _boot(self, slot):
+        launched = time.perf_counter()
+        if self.fake_realm is not None:
+            process = run_fake_realm(self.unix_socket, 1, self.fake_realm)
+            # Fake realms connect anonymously, tell them apart by their process
+            waiter = self.warden.wait_for_unclaimed_realm(self.claimed, process.pid)
+        else:
+            slot.disk = prepare_disk(slot.disk, method=self.disk_clone)
+            process = run_qemu(self.kernel, slot.disk, slot.tap_device, slot.mac, slot.guest_cid, slot.qemu_serial, config=self.qemu_config)
+            waiter = self.warden.wait_for_realm(slot.guest_cid)
+        self.processes.add(process)
+
+        try:
+            key = await wait_for_boot(waiter, process, self.boot_timeout)
+        except BaseException as e:
+            stop_processes([process])
+            self.processes.discard(process)
+            if isinstance(e, RealmBootError):
+                raise RealmBootError(f"{describe_slot(slot, self.fake_realm)} {e}") from None
+            raise
+        if self.fake_realm is None:
+            key = slot.guest_cid
+            self.claimed.add(key)
+
+        return PooledRealm(key, slot, process, time.perf_counter() - launched)
+
+    async def _boot_into_pool(self, slot):
+        try:
+            realm = await self._boot(slot)
+        except RealmBootError as e:
+            async with self.changed:
+                self.failed = e
+                self.changed.notify_all()
+            return
+        finally:
+            self.booting -= 1
+
+        self.refill_latency.record(int(realm.boot_time * 1e9))
+        async with self.changed:
+            self.ready.append(realm)
+            self.changed.notify_all()
+
+    def _refill(self):
+        import asyncio
+        while len(self.ready) + self.booting < self.size and self.free_slots:
+            self.booting += 1
+            task = asyncio.create_task(self._boot_into_pool(self.free_slots.popleft()))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def acquire(self):
+        if self.ready:
+            self.hits += 1
+            realm = self.ready.popleft()
+        elif self.free_slots:
+            self.misses += 1
+            realm = await self._boot(self.free_slots.popleft())
+        else:
+            # Every slot is either in use or still booting
+            self.misses += 1
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.ready or self.failed)
+                if self.failed:
+                    raise self.failed
+                realm = self.ready.popleft()
+
+        self._refill()
+        return realm
+
+    async def release(self, realm):
+        """Shuts the realm down and recycles its slot"""
+        import asyncio
+        await self.warden.shutdown(realm.key)
+        self.claimed.discard(realm.key)
+        await asyncio.to_thread(realm.process.communicate)
+        self.processes.discard(realm.process)
+        if self.fake_realm is None:
+            # The next realm in this slot has to start from an unprovisioned disk
+            os.unlink(realm.slot.disk)
+
+        async with self.changed:
+            self.free_slots.append(realm.slot)
+            self.changed.notify_all()
+        self._refill()
+
+    async def close(self):
+        import asyncio
+        # Stops refilling, released realms are not replaced any more
+        self.size = 0
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        while self.ready:
+            await self.release(self.ready.popleft())
+        await self.warden.close()
+
+    async def abort(self):
+        """Stops every realm of the pool without shutting them down first, e.g. after a failed boot"""
+        import asyncio
+        self.size = 0
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        stop_processes(self.processes)
+        self.processes.clear()
+        self.ready.clear()
+        await self.warden.close()
+
+    def stats(self):
+        return {
+            "ready": len(self.ready),
+            "booting": self.booting,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refill_latency": self.refill_latency.summary(),
+        }
+
+async def run_pool(args):
+    pool = RealmPool(kernel=args.kernel, size=args.warm_pool, vsock_port=args.vsock_port, guest_cid=args.guest_cid, tap_device=args.tap_device, max_frame_size=args.max_frame_size, disk_clone=args.disk_clone,
+                     fake_realm=args.fake_realm_args if args.fake_realm else None, unix_socket=args.unix_socket, qemu_config=args.qemu_config, codec=args.json_codec,
+                     boot_timeout=args.boot_timeout)
+    await pool.start()
+    print(f"Waiting for {args.warm_pool} realms to boot")
+
+    provision = LatencyHistogram()
+    try:
+        await pool.wait_until_full()
+        for _ in range(args.pool_requests):
+            start = time.perf_counter_ns()
+            realm = await pool.acquire()
+            r = await pool.warden.provision(realm.key, default_apps(args.use_oci))
+            provision.record(time.perf_counter_ns() - start)
+            print(f"Realm {realm.key} provisioning finished with {r}")
+            await pool.release(realm)
+    except RealmBootError:
+        await pool.abort()
+        raise
+
+    stats = pool.stats()
+    await pool.close()
+
+    refill = stats["refill_latency"]
+    print(f"Pool hits {stats['hits']}, misses {stats['misses']}")
+    print(f"Refill latency: p50 {refill['p50_ns'] / 1e9:.3f}s, max {refill['max_ns'] / 1e9:.3f}s over {refill['count']} boots")
+    print(f"Acquire and provision: p50 {provision.percentile(50) / 1e6:.1f} ms, max {provision.max / 1e6:.1f} ms")
+
+async def run_fleet(args):
+    fleet = RealmFleet(kernel=args.kernel, count=args.realms, vsock_port=args.vsock_port, guest_cid=args.guest_cid, tap_device=args.tap_device, max_frame_size=args.max_frame_size, disk_clone=args.disk_clone,
+                       fake_realm=args.fake_realm_args if args.fake_realm else None, unix_socket=args.unix_socket, qemu_config=args.qemu_config, codec=args.json_codec,
+                       boot_timeout=args.boot_timeout)
+    await fleet.launch()
+    fleet.report()
+
+    for key, r in (await fleet.provision_all(default_apps(args.use_oci))).items():
+        print(f"Realm {key} provisioning finished with {r}")
+
+    await fleet.shutdown()
+
+def run_bench(host, iterations, output, apps, window = 16):
+    """Times every request type against an already running realm"""
+    hist = {}
+    elapsed = {}
+
+    def timed(name, fn):
+        start = time.perf_counter_ns()
+        r = fn()
+        took = time.perf_counter_ns() - start
+        hist.setdefault(name, LatencyHistogram()).record(took)
+        elapsed[name] = elapsed.get(name, 0) + took
+        return r
+
+    r = timed("ProvisionInfo", lambda: host.provision(apps))
+    print(f"Provisioning finished with {r}")
+
+    for _ in range(iterations):
+        timed("CheckStatus", host.check_app)
+    for _ in range(iterations):
+        timed("StopApp", host.stop_app)
+        timed("StartApp", host.start_app)
+        timed("KillApp", host.kill_app)
+        timed("StartApp", host.start_app)
+    for _ in range(iterations):
+        timed("GetIfAddrs", host.getifaddrs)
+
+    # Amortized per request cost, comparing it with CheckStatus shows how much is round trip time
+    name = f"CheckStatus (pipelined x{window})"
+    for _ in range(max(iterations // window, 1)):
+        start = time.perf_counter_ns()
+        host.check_apps([APP_ID] * window, window)
+        took = time.perf_counter_ns() - start
+        for _ in range(window):
+            hist.setdefault(name, LatencyHistogram()).record(took // window)
+        elapsed[name] = elapsed.get(name, 0) + took
+    # The realm is provisioned already so this measures the rejection path
+    for _ in range(iterations):
+        timed("ProvisionInfo (repeated)", lambda: host.provision(apps))
+
+    results = {}
+    print(f"{'request':30} {'count':>6} {'p50 us':>10} {'p90 us':>10} {'p99 us':>10} {'max us':>10} {'req/s':>10}")
+    for name, h in hist.items():
+        results[name] = h.summary()
+        results[name]["throughput_rps"] = h.count / (elapsed[name] / 1e9)
+        print(f"{name:30} {h.count:6} {h.percentile(50) / 1000:10.1f} {h.percentile(90) / 1000:10.1f} {h.percentile(99) / 1000:10.1f} {h.max / 1000:10.1f} {results[name]['throughput_rps']:10.1f}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"timestamp": time.time(), "iterations": iterations, "results": results}, f, indent=2)
+        print(f"Benchmark results written to {output}")
+
+def bench_json_codecs(iterations = 1000, app_counts = (1, 16, 64), token_size = 32 + 1086):
+    """Times encoding and decoding of the largest realm frames with every installed codec
+
+    Decoding starts from a memoryview into a bytearray, like frames returned
+    by FrameReader. The token is the size fake_realm.py sends by default.
+    """
+    base = default_apps()[0]
+    payloads = [(f"ProvisionInfo, {n} apps", {"ProvisionInfo": [replace(base, id=str(uuid.uuid4())).__dict__ for _ in range(n)]}) for n in app_counts]
+    payloads.append(("GetAttestationToken", {"GetAttestationToken": list(os.urandom(64))}))
+    payloads.append(("AttestationToken", {"AttestationToken": list(os.urandom(token_size))}))
+
+    codecs = []
+    for name in JSON_CODECS:
+        try:
+            codecs.append(json_codec(name))
+        except ImportError:
+            print(f"{name} is not installed, skipping it")
+
+    for label, payload in payloads:
+        for codec in codecs:
+            frame = codec.encode(payload)
+            view = memoryview(bytearray(frame))
+            assert codec.decode(view) == payload
+
+            start = time.perf_counter_ns()
+            for _ in range(iterations):
+                codec.encode(payload)
+            encode = (time.perf_counter_ns() - start) / iterations
 
+            start = time.perf_counter_ns()
+            for _ in range(iterations):
+                codec.decode(view)
+            decode = (time.perf_counter_ns() - start) / iterations
 
+            print(f"{label:24} {codec.name:6} {len(frame):>7} bytes: encode {encode / 1000:8.1f} us, decode {decode / 1000:8.1f} us")
+
+def run_token_bench(host, iterations, window = 16):
+    """Measures attestation token throughput, latency and size on the wire"""
+    hist = LatencyHistogram()
+    errors = 0
+    token_size = 0
+    challenge = os.urandom(64)
+
+    sent, received = host.bytes_sent, host.reader.bytes_received
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        t = time.perf_counter_ns()
+        r = host.get_attestation_token(challenge)
+        hist.record(time.perf_counter_ns() - t)
+        if isinstance(r, bytes):
+            token_size = len(r)
+        else:
+            errors += 1
+            if errors == 1:
+                print(f"Token request failed with {r}")
+    elapsed = time.perf_counter_ns() - start
+    sent, received = host.bytes_sent - sent, host.reader.bytes_received - received
+
+    # A burst of clients asking at once
+    req = {"GetAttestationToken": list(challenge)}
+    burst = time.perf_counter_ns()
+    host.transaction_many([req] * iterations, window)
+    burst = time.perf_counter_ns() - burst
+
+    print(f"Tokens: {iterations - errors}/{iterations} ok, {token_size} bytes each")
+    print(f"Sequential: {iterations / (elapsed / 1e9):.1f} tokens/s, p50 {hist.percentile(50) / 1000:.1f} us, p99 {hist.percentile(99) / 1000:.1f} us, max {hist.max / 1000:.1f} us")
+    print(f"Pipelined x{window}: {iterations / (burst / 1e9):.1f} tokens/s")
+    print(f"On the wire per token: {sent / iterations:.0f} bytes sent for a 64 byte challenge, {received / iterations:.0f} bytes received", end="")
+    if token_size:
+        print(f" ({received / iterations / token_size:.2f}x the token size)")
+    else:
+        print()
+
+# Disk backends compared by --bench-blk
+BLK_BACKENDS = [
+    {},
+    {"disk_device": "virtio-blk-pci", "aio": "threads", "cache": "writeback"},
+    {"disk_device": "virtio-blk-pci", "aio": "io_uring", "cache": "none"},
+    {"disk_device": "virtio-blk-pci", "aio": "native", "cache": "none"},
+    {"disk_device": "virtio-blk-pci", "aio": "io_uring", "cache": "none", "iothread": True},
+]
+
+# NIC models compared by --bench-nic
+NIC_MODELS = [
+    {},
+    {"nic": "virtio-net-pci"},
+    {"nic": "virtio-net-pci", "vhost": True},
+    {"nic": "virtio-net-pci", "vhost": True, "queues": 2},
+]
+
+# Serial console phases reported by the sweep when the console is captured
+SWEEP_PHASES = ["dm_crypt", "mkfs_mount", "oci_pull", "installation"]
+
+def run_sweep(host, configs, rounds, output, apps):
+    """Boots, provisions and shuts down the realm `rounds` times under every QEMU configuration
+
+    With a captured serial console the time spent in dm-crypt setup, ext2
+    formatting and mounting and the whole installation is reported as well.
+    """
+    results = []
+    for config in configs:
+        boot = LatencyHistogram()
+        provision = LatencyHistogram()
+        phases = {}
+        host.qemu_config = config
+        for i in range(rounds):
+            print(f"Booting with {config.label()} ({i + 1}/{rounds})")
+            host.start(fresh_disk=True)
+            boot.record(int((host.connected - host.launched - host.paused) * 1e9))
+
+            start = time.perf_counter_ns()
+            r = host.provision(apps)
+            provision.record(time.perf_counter_ns() - start)
+            print(f"Provisioning finished with {r}")
+
+            if host.serial_capture is not None:
+                timeline = host.serial_capture.timeline
+                timeline.wait_for_event("provisioned", timeout=5)
+                with timeline.lock:
+                    boot_phases = timeline.phases(timeline.boots[-1])
+                for name, took in boot_phases.items():
+                    phases.setdefault(name, LatencyHistogram()).record(int(took * 1e9))
+            host.shutdown()
+
+        results.append({"config": asdict(config), "boot_to_connect": boot.summary(), "provision": provision.summary(),
+                        "phases": {name: h.summary() for name, h in phases.items()}})
+
+    width = max(len(c.label()) for c in configs)
+    columns = [name for name in SWEEP_PHASES if any(name in r["phases"] for r in results)]
+    print(f"{'configuration':{width}} {'boot p50 s':>11} {'boot max s':>11} {'prov p50 s':>11} {'prov max s':>11}" + "".join(f" {name + ' p50 s':>18}" for name in columns))
+    for config, r in zip(configs, results):
+        b, p = r["boot_to_connect"], r["provision"]
+        line = f"{config.label():{width}} {b['p50_ns'] / 1e9:11.3f} {b['max_ns'] / 1e9:11.3f} {p['p50_ns'] / 1e9:11.3f} {p['max_ns'] / 1e9:11.3f}"
+        for name in columns:
+            line += f" {r['phases'][name]['p50_ns'] / 1e9:18.3f}" if name in r["phases"] else f" {'-':>18}"
+        print(line)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"timestamp": time.time(), "rounds": rounds, "results": results}, f, indent=2)
+        print(f"Sweep results written to {output}")
+
+def run_scaling_bench(host, counts, base_app, partition_size, output, preformat = False, vendor_data = None):
+    """Provisions 1..N copies of `base_app` on freshly booted realms with a partition pair per app
+
+    The serial console splits provisioning into the concurrent installation
+    (dm-crypt, mkfs, image), the serial measurement into the REM and the
+    app starts.
+    """
+    results = []
+    for count in counts:
+        host.layout, apps = multi_app_layout(count, base_app, partition_size, preformat, vendor_data)
+        host.start(fresh_disk=True)
+
+        start = time.perf_counter()
+        r = host.provision(apps)
+        total = time.perf_counter() - start
+        print(f"Provisioning {count} apps finished with {r} in {total:.3f}s")
+
+        result = {"apps": count, "response": r, "total": total}
+        if host.serial_capture is not None and host.fake_realm is None:
+            timeline = host.serial_capture.timeline
+            timeline.wait_for_event("provisioned", timeout=5)
+            with timeline.lock:
+                result.update(SerialTimeline.provisioning(timeline.boots[-1]) or {})
+        results.append(result)
+        host.shutdown()
+    host.remove_disk()
+
+    print(f"{'apps':>5} {'total s':>9} {'install s':>10} {'app p50 s':>10} {'app max s':>10} {'measure s':>10} {'start s':>9}")
+    for r in results:
+        line = f"{r['apps']:5} {r['total']:9.3f}"
+        if "install" in r:
+            per_app = sorted(r["per_app_install"]) or [0.0]
+            line += f" {r['install']:10.3f} {per_app[len(per_app) // 2]:10.3f} {per_app[-1]:10.3f} {r['measure']:10.3f} {r['start']:9.3f}"
+        print(line)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"timestamp": time.time(), "partition_size": partition_size, "results": results}, f, indent=2)
+        print(f"Scaling results written to {output}")
+
+
+def command_parser():
+    """Parser of the commands typed into the REPL or passed with --script/--commands"""
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='command')
 
@@ -182,17 +2145,567 @@ def main():
     _ = subparsers.add_parser("launch", help="Launch QEMU after issued shutdown")
     _ = subparsers.add_parser("getifaddrs", help="Read ip addresses of network interfaces")
     _ = subparsers.add_parser("invalid_json")
+    _ = subparsers.add_parser("get_token", help="Request an attestation token for a random challenge")
+    stats_parser = subparsers.add_parser("stats", help="Print guest resource samples taken with --stats-interval")
+    stats_parser.add_argument("--last", type=int, default=1)
+    sleep_parser = subparsers.add_parser("sleep", help="Wait before running the next command")
+    sleep_parser.add_argument("seconds", type=float)
+    wait_until_parser = subparsers.add_parser("wait_until", help="Poll CheckStatus until the application reaches a status")
+    wait_until_parser.add_argument("status", type=str, help="Status response, e.g. ApplicationIsRunning or ApplicationExited")
+    wait_until_parser.add_argument('--uuid', type=uuid.UUID, default=APP_ID)
+    wait_until_parser.add_argument("--timeout", type=float, default=60.0)
+    wait_until_parser.add_argument("--interval", type=float, default=0.01, help="First poll interval, it backs off up to --max-interval")
+    wait_until_parser.add_argument("--max-interval", type=float, default=0.5)
+    watch_parser = subparsers.add_parser("watch", help="Print status changes of applications")
+    watch_parser.add_argument('--uuid', type=uuid.UUID, action="append", help="Application to watch, can be repeated")
+    watch_parser.add_argument("--timeout", type=float, default=10.0)
+    watch_parser.add_argument("--interval", type=float, default=0.01)
+    watch_parser.add_argument("--max-interval", type=float, default=0.5)
     _ = subparsers.add_parser("exit")
+    return parser
+
+def wait_until(host, status, id = APP_ID, timeout = 60.0, interval = 0.01, max_interval = 0.5):
+    """Polls CheckStatus until its response is `status`, raises TimeoutError otherwise"""
+    watcher = host.watch_apps([id], min_interval=interval, max_interval=max_interval)
+    return watcher.wait_for(status, timeout)[str(id)]
+
+def watch(host, ids, timeout, interval = 0.01, max_interval = 0.5):
+    """Prints status changes of `ids` for `timeout` seconds and returns their last status"""
+    watcher = host.watch_apps(ids, min_interval=interval, max_interval=max_interval)
+    start = time.time()
+    for c in watcher.changes(timeout):
+        print(f"{c.time - start:8.3f}s {c.id}: {c.old} -> {c.new}")
+    print(f"{watcher.polls} polls of {len(ids)} applications in {timeout}s")
+    return watcher.status
+
+def run_command(host, args, im_url):
+    cmd = args.command
+
+    r = None
+    if cmd == "start_app":
+        r = host.start_app(id=args.uuid)
+    elif cmd == "stop_app":
+        r = host.stop_app(id=args.uuid)
+    elif cmd == "kill_app":
+        r = host.kill_app(id=args.uuid)
+    elif cmd == "check_app":
+        r = host.check_app(id=args.uuid)
+    elif cmd == "shutdown":
+        host.shutdown()
+    elif cmd == "reboot":
+        host.reboot()
+        host.reconnect()
+        p = host.send_dummy_provision_info()
+        print(f"Provisioning finished with {p}")
+    elif cmd == "launch":
+        host.run_qemu()
+        host.reconnect()
+        p = host.send_dummy_provision_info()
+        print(f"Provisioning finished with {p}")
+    elif cmd == "invalid_json":
+        r = host.invalid_json()
+    elif cmd == "exit":
+        sys.exit()
+    elif cmd == "getifaddrs":
+        r = host.getifaddrs()
+    elif cmd == "get_token":
+        r = host.get_attestation_token()
+        if isinstance(r, bytes):
+            r = f"{len(r)} byte token {r[:16].hex()}..."
+    elif cmd == "stats":
+        samples = host.stats(args.last + 1)
+        for previous, sample in list(zip([None] + samples, samples))[-args.last:]:
+            print(QemuStats.summary(sample, previous))
+    elif cmd == "sleep":
+        time.sleep(args.seconds)
+    elif cmd == "wait_until":
+        r = wait_until(host, args.status, args.uuid, args.timeout, args.interval, args.max_interval)
+    elif cmd == "watch":
+        r = watch(host, args.uuid or [APP_ID], args.timeout, args.interval, args.max_interval)
+    elif cmd == "setup_exmapleapp":
+        r = host.send_exmapleapp_provision_info(im_url)
+
+    return r
+
+def parse_batch(parser, lines):
+    """Turns script lines into (count, text, args) steps
+
+    Commands are separated by newlines or `;`, `#` starts a comment and
+    `repeat N <command>` runs the command N times.
+    """
+    steps = []
+    for line in lines:
+        for text in line.split("#", 1)[0].split(";"):
+            text = text.strip()
+            if not text:
+                continue
+            tokens = shlex.split(text)
+            count = 1
+            if tokens[0] == "repeat":
+                if len(tokens) < 3 or not tokens[1].isdigit():
+                    raise ValueError(f"Expected repeat <count> <command>, got {text}")
+                count, tokens = int(tokens[1]), tokens[2:]
+            steps.append((count, text, parser.parse_args(tokens)))
+    return steps
+
+def batch_records(host, steps, im_url):
+    """Runs the steps and yields a record per executed command
+
+    Error responses are recorded and the batch goes on, it stops after the
+    first command that raises, e.g. a wait_until timeout or a lost
+    connection.
+    """
+    for index, (count, text, args) in enumerate(steps):
+        for i in range(count):
+            record = {"index": index, "iteration": i, "command": text}
+            start = time.perf_counter_ns()
+            try:
+                r = run_command(host, args, im_url)
+                record["ok"] = not (isinstance(r, dict) and "Error" in r)
+                record["result"] = r
+            except (TimeoutError, OSError, ValueError) as e:
+                record["ok"] = False
+                record["error"] = str(e)
+            record["elapsed_ms"] = (time.perf_counter_ns() - start) / 1e6
+
+            yield record
+            if "error" in record:
+                return
+
+def write_records(records, output = "-"):
+    """Writes a JSON line per record to `output`, a path, "-" or an open stream
+    Returns whether none of them failed with an error."""
+    if output == "-":
+        output = sys.stdout
+    out = open(output, "w") if isinstance(output, str) else output
+    try:
+        for record in records:
+            out.write(json.dumps(record, default=str) + "\n")
+            out.flush()
+            if "error" in record:
+                return False
+    finally:
+        if out is not output:
+            out.close()
+    return True
+
+def run_batch(host, steps, im_url, output = "-"):
+    """Runs the steps and writes a JSON line per executed command to `output`
+
+    Returns whether all commands completed, see batch_records().
+    """
+    return write_records(batch_records(host, steps, im_url), output)
+
+def write_frame(conn, obj):
+    s = json.dumps(obj, default=str).encode()
+    conn.sendall(struct.pack(">I", len(s)) + s)
+
+class ThreadOutput():
+    """Stands in for sys.stdout, keeps what a capturing thread prints apart"""
+
+    def __init__(self, stream, local = None):
+        self.stream = stream
+        self.local = local or threading.local()
+
+    def capture(self):
+        self.local.buf = io.StringIO()
+
+    def collect(self):
+        buf = getattr(self.local, "buf", None)
+        self.local.buf = None
+        return buf.getvalue() if buf is not None else ""
+
+    def write(self, s):
+        buf = getattr(self.local, "buf", None)
+        return (buf if buf is not None else self.stream).write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class HostDaemon():
+    """Keeps realms running and serves REPL commands sent to a unix control socket
+
+    A request is a `>I` length prefixed JSON object {"realm": index,
+    "commands": text} with the commands in --script syntax. The daemon
+    answers with a frame per executed command, the --jsonl record plus what
+    the command printed, followed by {"done": true}. Clients are served
+    concurrently, commands for the same realm run one at a time. `exit`
+    closes the client's connection, the daemon stops on SIGINT or SIGTERM.
+    """
+
+    def __init__(self, hosts, path, im_url = None):
+        self.hosts = hosts
+        self.locks = [threading.Lock() for _ in hosts]
+        self.path = path
+        self.im_url = im_url
+        self.parser = command_parser()
+        self.stdout = ThreadOutput(sys.stdout)
+        self.stderr = ThreadOutput(sys.stderr, self.stdout.local)
+
+    def parse(self, text):
+        """Returns the steps of `text` up to an `exit` and whether there was one"""
+        self.stdout.capture()
+        try:
+            steps = parse_batch(self.parser, text.splitlines())
+        except (ValueError, SystemExit) as e:
+            # argparse prints its error and exits
+            raise ValueError(self.stdout.collect().strip() or str(e))
+        self.stdout.collect()
+
+        commands = [args.command for _, _, args in steps]
+        if "exit" in commands:
+            return steps[:commands.index("exit")], True
+        return steps, False
+
+    def run(self, realm, steps):
+        records = batch_records(self.hosts[realm], steps, self.im_url)
+        while True:
+            with self.locks[realm]:
+                self.stdout.capture()
+                record = next(records, None)
+                output = self.stdout.collect()
+            if record is None:
+                return
+            if output:
+                record["output"] = output
+            yield record
+
+    def handle(self, conn):
+        reader = FrameReader()
+        with conn:
+            while True:
+                closing = False
+                try:
+                    req = json.loads(bytes(reader.read_frame(conn)))
+                    if not isinstance(req, dict) or not isinstance(req.get("commands"), str):
+                        raise ValueError(f"Invalid request {req}, expected {{\"realm\": index, \"commands\": text}}")
+                    text = req["commands"]
+                    realm = req.get("realm", 0)
+                    if not isinstance(realm, int) or not 0 <= realm < len(self.hosts):
+                        raise ValueError(f"No realm {realm}, the daemon runs {len(self.hosts)}")
+                    steps, closing = self.parse(text)
+                    for record in self.run(realm, steps):
+                        write_frame(conn, record)
+                    write_frame(conn, {"done": True})
+                except ValueError as e:
+                    try:
+                        write_frame(conn, {"ok": False, "error": str(e)})
+                        write_frame(conn, {"done": True})
+                    except OSError:
+                        return
+                except OSError:
+                    # Also when the client stops reading after the first error
+                    return
+                if closing:
+                    return
+
+    def serve_forever(self):
+        sock = listen_unix(self.path, socket.SOMAXCONN)
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        # Background jobs start with SIGINT ignored
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.default_int_handler)
+        print(f"Serving {len(self.hosts)} realms on {self.path}")
+        try:
+            while True:
+                conn, _ = sock.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.unlink(self.path)
+            sys.stdout, sys.stderr = self.stdout.stream, self.stderr.stream
+            for host in self.hosts:
+                host.qemu.terminate()
+                host.qemu.wait()
+                host.close_qmp()
+            print(f"Stopped {len(self.hosts)} realms")
+
+class ControlClient():
+    """Sends REPL commands to the realms of a run.py --daemon"""
+
+    def __init__(self, path, realm = 0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.realm = realm
+        self.reader = FrameReader()
+
+    def run(self, commands):
+        """Sends commands in --script syntax and yields the record of every executed command"""
+        write_frame(self.sock, {"realm": self.realm, "commands": commands})
+        while True:
+            record = json.loads(bytes(self.reader.read_frame(self.sock)))
+            if record.get("done"):
+                return
+            yield record
+
+    def close(self):
+        self.sock.close()
+
+def run_client(path, realm, commands = None, output = "-"):
+    """Runs `commands` on a daemon realm like --script does, reads them from stdin when None"""
+    client = ControlClient(path, realm)
+    try:
+        if commands is not None:
+            return write_records(client.run(commands), output)
+
+        while True:
+            sys.stdout.write("> ")
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+            if not line or line.strip() == "exit":
+                return True
+            for record in client.run(line):
+                sys.stdout.write(record.get("output", ""))
+                print(f"Command returned: {record['error'] if 'error' in record else record.get('result')}")
+    finally:
+        client.close()
+
+def profile_startup(argv, top = 25):
+    """Imports run.py and parses `argv` in a fresh interpreter with -X importtime, then prints where the time went"""
+    code = ("import sys, time; start = time.perf_counter(); import run; imported = time.perf_counter(); "
+            "run.argument_parser().parse_args(sys.argv[1:]); print(imported - start, time.perf_counter() - imported)")
+    path = [os.path.dirname(os.path.abspath(__file__))] + os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, path)))
+
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code] + argv, env=env, capture_output=True, text=True)
+    total = time.perf_counter() - start
+    if p.returncode != 0:
+        raise RuntimeError(f"Startup failed with {p.returncode}: {p.stderr.strip().splitlines()[-1]}")
+    imported, parsed = map(float, p.stdout.split())
+
+    imports = []
+    for line in p.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            imports.append((int(fields[1]), int(fields[0]), fields[2].strip()))
+
+    print(f"Startup took {total * 1000:.1f} ms: {imported * 1000:.1f} ms importing run.py, {parsed * 1000:.1f} ms parsing arguments, "
+          f"{(total - imported - parsed) * 1000:.1f} ms interpreter start and exit")
+    print(f"Slowest of {len(imports)} imports, times include nested imports:")
+    print("import time: self [us] | cumulative | imported package")
+    for cumulative, self_us, name in sorted(imports, reverse=True)[:top]:
+        print(f"import time: {self_us:9} | {cumulative:10} | {name}")
+
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return n
+
+def argument_parser():
+    main_parser = argparse.ArgumentParser()
+    main_parser.add_argument("--vsock_port", type=int, default=1337)
+    main_parser.add_argument("--guest-cid", type=int, default=1337)
+    main_parser.add_argument("--tap-device", type=str, default="tap100")
+    main_parser.add_argument("--qemu-serial", type=str, default="tcp:localhost:1337")
+    main_parser.add_argument('--kernel', type=str, default='../linux/arch/arm64/boot/Image')
+    main_parser.add_argument("--test", action='store_true', default=False)
+    main_parser.add_argument("--use-oci", type=str, help="Image registry url", required=False)
+    main_parser.add_argument("--max-frame-size", type=int, default=MAX_FRAME_SIZE, help="Maximum size of a response frame in bytes")
+    main_parser.add_argument("--disk-clone", choices=["auto", "reflink", "qcow2", "copy"], default="auto", help="How realm disks are cloned from the cached template disk")
+    main_parser.add_argument("--bench-disk", action='store_true', default=False, help="Compare Disk.create with sparse disk creation and exit")
+    main_parser.add_argument("--bench", action='store_true', default=False, help="Measure request latencies and throughput, then shut the realm down")
+    main_parser.add_argument("--bench-iterations", type=int, default=100, help="How many times each request is sent in --bench mode")
+    main_parser.add_argument("--bench-output", type=str, default="bench.json", help="Where --bench writes its JSON results")
+    main_parser.add_argument("--json-codec", choices=["auto"] + list(JSON_CODECS), default="auto", help="JSON library used for realm frames, auto picks orjson when it is installed")
+    main_parser.add_argument("--bench-codec", action="store_true", default=False, help="Compare the JSON codecs on ProvisionInfo and attestation token frames and exit")
+    main_parser.add_argument("--bench-token", action='store_true', default=False, help="Measure attestation token throughput, latency and wire size, then shut the realm down")
+    main_parser.add_argument("--pipeline-depth", type=positive_int, default=16, help="Requests in flight at once for pipelined requests")
+    main_parser.add_argument("--capture-serial", action='store_true', default=False, help="Read the serial console instead of passing --qemu-serial to QEMU and build a boot phase timeline from it")
+    main_parser.add_argument("--serial-log", type=str, default="serial.log", help="File the captured serial console is appended to")
+    main_parser.add_argument("--timeline-output", type=str, default="timeline.json", help="JSON file the boot timeline is written to on exit")
+    main_parser.add_argument("--fake-realm", action='store_true', default=False, help="Run fake_realm.py instead of QEMU and talk to it over a unix socket")
+    main_parser.add_argument("--fake-realm-args", type=str, default="", help="Extra arguments passed to fake_realm.py, e.g. service times")
+    main_parser.add_argument("--unix-socket", type=str, default="warden.sock", help="Socket the host listens on with --fake-realm")
+    main_parser.add_argument("--snapshot", type=str, help="Boot from this VM state file, it is created by a cold boot when missing")
+    main_parser.add_argument("--snapshot-at", type=str, default="init_started", choices=SNAPSHOT_EVENTS,
+                             help="Serial console event at which the snapshot is taken, it has to come before app-manager connects")
+    main_parser.add_argument("--stats-interval", type=float, default=0, help="Sample guest resource use over QMP every this many seconds, 0 disables it")
+    main_parser.add_argument("--stats-samples", type=int, default=600, help="Number of resource samples kept")
+    main_parser.add_argument("--cpu", type=str, default=DEFAULT_QEMU_CONFIG.cpu, help="CPU model emulated by QEMU")
+    main_parser.add_argument("--smp", type=int, default=DEFAULT_QEMU_CONFIG.smp, help="Number of vCPUs")
+    main_parser.add_argument("--memory", type=int, default=DEFAULT_QEMU_CONFIG.memory, help="Guest memory in MiB")
+    main_parser.add_argument("--accel", type=str, default=DEFAULT_QEMU_CONFIG.accel, help="QEMU accelerator, e.g. tcg or kvm")
+    main_parser.add_argument("--tcg-thread", choices=["single", "multi"], help="Run all vCPUs on one thread or a thread per vCPU")
+    main_parser.add_argument("--tb-size", type=int, help="Size of the TCG translation cache in MiB")
+    main_parser.add_argument("--sweep", type=str, action="append", default=[], metavar="OPTION=VALUE,...",
+                             help="Boot and provision the realm with these QEMU options on top of the ones above, e.g. smp=4,thread=multi,tb-size=512. Can be repeated")
+    main_parser.add_argument("--disk-device", type=str, help="Attach the disk as an if=none drive to this device, e.g. virtio-blk-pci")
+    main_parser.add_argument("--aio", choices=["threads", "native", "io_uring"], help="Asynchronous I/O used by QEMU for the disk")
+    main_parser.add_argument("--cache", choices=["none", "writeback", "writethrough", "directsync", "unsafe"], help="Host page cache mode of the disk")
+    main_parser.add_argument("--iothread", action="store_true", default=False, help="Serve the disk from a dedicated iothread")
+    main_parser.add_argument("--bench-blk", action="store_true", default=False,
+                             help="Sweep over the disk backends and report dm-crypt setup and ext2 formatting times from the serial console")
+    main_parser.add_argument("--nic", type=str, default=DEFAULT_QEMU_CONFIG.nic, help="NIC model of the realm, e.g. e1000 or virtio-net-pci")
+    main_parser.add_argument("--vhost", action="store_true", default=False, help="Process virtio-net packets in the host kernel with vhost-net")
+    main_parser.add_argument("--queues", type=int, help="Number of virtio-net queue pairs, the tap has to be created with multi_queue")
+    main_parser.add_argument("--bench-nic", action="store_true", default=False,
+                             help="Sweep over the NIC models and report the OCI image pull time of --use-oci from the serial console")
+    main_parser.add_argument("--bench-scaling", type=lambda v: [int(n) for n in v.split(",")], metavar="N,N,...",
+                             help="Provision this many apps on a fresh realm each, e.g. 1,2,4,8,16,32,64, and report install, measurement and start times")
+    main_parser.add_argument("--scaling-partition-size", type=int, default=256, help="Size of every image and data partition of --bench-scaling in MiB")
+    main_parser.add_argument("--scaling-output", type=str, default="scaling.json", help="JSON file with the --bench-scaling results")
+    main_parser.add_argument("--preformat", action="store_true", default=False,
+                             help="Put encrypted ext2 filesystems on the realm disk so app-manager mounts them without mkfs, needs a realm built with the Dummy key sealing. "
+                                  "The first run per partition size and key encrypts the templates in Python, roughly 10 s per GiB")
+    main_parser.add_argument("--vendor-data", type=bytes.fromhex, action="append", metavar="HEX",
+                             help="Vendor data returned by the launcher, used to derive the --preformat data partition key. Defaults to the Dummy launcher's 112233, can be repeated")
+    main_parser.add_argument("--sweep-rounds", type=int, default=3, help="Boots per --sweep configuration")
+    main_parser.add_argument("--sweep-output", type=str, default="sweep.json", help="JSON file with the --sweep results")
+    main_parser.add_argument("--script", type=str, help="Run the REPL commands in this file instead of reading them from stdin")
+    main_parser.add_argument("--commands", type=str, help="Run these `;` separated REPL commands instead of reading them from stdin")
+    main_parser.add_argument("--jsonl", type=str, default="-", help="Where --script and --commands write a JSON line per command, - is stdout")
+    main_parser.add_argument("--daemon", type=str, metavar="SOCKET", help="Keep the realms running and serve REPL commands sent to this unix socket with --connect")
+    main_parser.add_argument("--connect", type=str, metavar="SOCKET", help="Send the REPL commands, --script or --commands to the realms of a --daemon instead of booting a realm")
+    main_parser.add_argument("--realm", type=int, default=0, help="Index of the --daemon realm the --connect commands are sent to")
+    main_parser.add_argument("--warm-pool", type=int, default=0, help="Keep this many realms booted and serve --pool-requests provisioning requests from them")
+    main_parser.add_argument("--pool-requests", type=int, default=10, help="Realms acquired, provisioned and released in --warm-pool mode")
+    main_parser.add_argument("--realms", type=int, default=1, help="Boot this many realms in parallel, provision them and shut them down")
+    main_parser.add_argument("--boot-timeout", type=float, default=600, help="Seconds a --realms or --warm-pool realm may take to connect before all of them are stopped")
+    main_parser.add_argument("--profile-startup", action="store_true", default=False,
+                             help="Print the import and argument parsing time of run.py with the other arguments, then exit")
+    return main_parser
+
+def main():
+    main_parser = argument_parser()
+    args = main_parser.parse_args()
+    if args.profile_startup:
+        profile_startup([a for a in sys.argv[1:] if a != "--profile-startup"])
+        return
+
+    try:
+        args.qemu_config = QemuConfig(cpu=args.cpu, smp=args.smp, memory=args.memory, accel=args.accel, thread=args.tcg_thread, tb_size=args.tb_size,
+                                      disk_device=args.disk_device, aio=args.aio, cache=args.cache, iothread=args.iothread,
+                                      nic=args.nic, vhost=args.vhost, queues=args.queues)
+        sweep = [parse_qemu_config(c, args.qemu_config) for c in args.sweep]
+        if args.bench_blk and not sweep:
+            sweep = [replace(args.qemu_config, **backend) for backend in BLK_BACKENDS]
+        if args.bench_nic and not sweep:
+            sweep = [replace(args.qemu_config, **model) for model in NIC_MODELS]
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        main_parser.error(str(e))
+
+    if args.bench_disk:
+        bench_disk_creation()
+        return
+
+    if args.bench_codec:
+        bench_json_codecs()
+        return
+
+    if args.connect:
+        try:
+            if args.script:
+                with open(args.script) as f:
+                    commands = f.read()
+            else:
+                commands = args.commands
+            ok = run_client(args.connect, args.realm, commands, args.jsonl)
+        except (OSError, ValueError) as e:
+            main_parser.error(str(e))
+        if not ok:
+            sys.exit(1)
+        return
+
+    try:
+        if args.warm_pool > 0:
+            import asyncio
+            asyncio.run(run_pool(args))
+            return
+
+        if args.realms > 1 and not args.daemon:
+            import asyncio
+            asyncio.run(run_fleet(args))
+            return
+    except RealmBootError as e:
+        sys.exit(f"Error: {e}, stopped all realms")
+
+
+    steps = []
+    try:
+        if args.script:
+            with open(args.script) as f:
+                steps = parse_batch(command_parser(), f)
+        elif args.commands:
+            steps = parse_batch(command_parser(), [args.commands])
+    except (OSError, ValueError) as e:
+        main_parser.error(str(e))
+
+    jsonl = args.jsonl
+    if steps and jsonl == "-":
+        # stdout only carries the JSON lines, everything printed along the way goes to stderr
+        jsonl, sys.stdout = sys.stdout, sys.stderr
 
     if "use_oci" in args:
         im_url = args.use_oci
     else:
         im_url = None
 
-    host = MockedWarden(kernel=args.kernel, vsock_port=args.vsock_port, guest_cid=args.guest_cid, tap_device=args.tap_device, qemu_serial=args.qemu_serial)
+    if (args.snapshot or args.stats_interval or sweep) and args.fake_realm:
+        main_parser.error("--snapshot, --stats-interval and --sweep need QEMU, they cannot be used with --fake-realm")
+    if args.bench_scaling and not all(1 <= n <= 64 for n in args.bench_scaling):
+        main_parser.error("--bench-scaling counts have to be between 1 and 64, the GPT holds 128 partitions")
+    if args.bench_nic and not args.use_oci:
+        main_parser.error("--bench-nic measures the image pull, it needs --use-oci")
+    if args.snapshot and sweep:
+        main_parser.error("--snapshot cannot be restored with a different --sweep configuration")
+    if args.daemon and args.realms > 1 and not args.fake_realm:
+        main_parser.error("--daemon runs several realms only with --fake-realm, QEMU realms all connect to the same vsock port")
+
+    serial_capture = None
+    if args.capture_serial or args.bench_blk or args.bench_nic or (args.bench_scaling and not args.fake_realm) or args.snapshot:
+        serial_capture = SerialCapture(f"serial-{args.guest_cid}.sock", args.serial_log)
+        atexit.register(serial_capture.report, args.timeline_output)
+
+    layout = DEFAULT_LAYOUT
+    if args.preformat and not args.fake_realm:
+        layout, _ = build_layout([AppDisk(app) for app in default_apps(args.use_oci)], preformat=True, vendor_data=args.vendor_data)
+
+    qmp_config = QmpConfig(snapshot=args.snapshot, snapshot_at=args.snapshot_at, stats_interval=args.stats_interval, stats_capacity=args.stats_samples)
+    host_args = dict(kernel=args.kernel, vsock_port=args.vsock_port, guest_cid=args.guest_cid, tap_device=args.tap_device, qemu_serial=args.qemu_serial,
+                     max_frame_size=args.max_frame_size, disk_clone=args.disk_clone, serial_capture=serial_capture,
+                     fake_realm=args.fake_realm_args if args.fake_realm else None, unix_socket=args.unix_socket,
+                     qemu_config=args.qemu_config, qmp_config=qmp_config, layout=layout, codec=args.json_codec)
+    host = MockedWarden(**host_args)
+
+    if sweep:
+        run_sweep(host, sweep, args.sweep_rounds, args.sweep_output, default_apps(args.use_oci))
+        return
+
+    if args.bench_scaling:
+        run_scaling_bench(host, args.bench_scaling, default_apps(args.use_oci)[0], args.scaling_partition_size * 1024 * 1024, args.scaling_output,
+                          args.preformat, args.vendor_data)
+        return
+
     host.start()
 
-    if args.test:
+    if args.daemon:
+        hosts = [host]
+        stem, ext = os.path.splitext(args.unix_socket)
+        for i in range(1, args.realms):
+            hosts.append(MockedWarden(**dict(host_args, unix_socket=f"{stem}-{i}{ext}")))
+            hosts[-1].start()
+        HostDaemon(hosts, args.daemon, im_url).serve_forever()
+        return
+
+    if args.bench:
+        run_bench(host, args.bench_iterations, args.bench_output, default_apps(args.use_oci), args.pipeline_depth)
+        host.shutdown()
+
+    elif args.bench_token:
+        p = host.provision(default_apps(args.use_oci))
+        print(f"Provisioning finished with {p}")
+        run_token_bench(host, args.bench_iterations, args.pipeline_depth)
+        host.shutdown()
+
+    elif steps:
+        if not run_batch(host, steps, im_url, jsonl):
+            sys.exit(1)
+
+    elif args.test:
         r = host.send_provision_info(args)
         assert r == {'Success': []}
 
@@ -230,6 +2743,7 @@ def main():
         print("Test pass")
 
     else:
+        parser = command_parser()
 
         while True:
             sys.stdout.write("> ")
@@ -241,38 +2755,10 @@ def main():
                 continue
 
             if "command" in args:
-                cmd = args.command
-
-                r = None
-                if cmd == "start_app":
-                    r = host.start_app(id=args.uuid)
-                elif cmd == "stop_app":
-                    r = host.stop_app(id=args.uuid)
-                elif cmd == "kill_app":
-                    r = host.kill_app(id=args.uuid)
-                elif cmd == "check_app":
-                    r = host.check_app(id=args.uuid)
-                elif cmd == "shutdown":
-                    host.shutdown()
-                elif cmd == "reboot":
-                    host.reboot()
-                    host.reconnect()
-                    p = host.send_dummy_provision_info()
-                    print(f"Provisioning finished with {p}")
-                elif cmd == "launch":
-                    host.run_qemu()
-                    host.reconnect()
-                    p = host.send_dummy_provision_info()
-                    print(f"Provisioning finished with {p}")
-                elif cmd == "invalid_json":
-                    r = host.invalid_json()
-                elif cmd == "exit":
-                    sys.exit()
-                elif cmd == "getifaddrs":
-                    r = host.getifaddrs()
-                elif cmd == "setup_exmapleapp":
-                    r = host.send_exmapleapp_provision_info(im_url)
-
+                try:
+                    r = run_command(host, args, im_url)
+                except TimeoutError as e:
+                    r = str(e)
                 print(f"Command returned: {r}")
 
 
@@ -0,0 +1,411 @@
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+import uuid
+from dataclasses import replace
+
+import pytest
+
+import fake_realm
+import run
+
+def frames(payloads):
+    return b"".join(struct.pack(">I", len(p)) + p for p in payloads)
+
+class ShortConn():
+    """Socket stand-in whose sendmsg takes at most `limit` bytes per call"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+        self.calls = []
+
+    def sendmsg(self, buffers):
+        assert len(buffers) <= run.IOV_MAX
+        self.calls.append(len(buffers))
+        sent = bytes(b"".join(bytes(b) for b in buffers)[:self.limit])
+        self.data += sent
+        return len(sent)
+
+    def sendall(self, data):
+        self.data += data
+
+def large_payloads(count):
+    return [bytes([i]) * (run.GATHER_MIN_FRAME_SIZE + i) for i in range(count)]
+
+def test_send_frames_resumes_short_sends():
+    payloads = large_payloads(3)
+    conn = ShortConn(limit=1000)
+    sent = run.send_frames(conn, payloads, bytearray(4 * len(payloads)))
+    assert sent == len(frames(payloads))
+    assert conn.data == frames(payloads)
+    assert len(conn.calls) > len(payloads)
+
+def test_send_frames_splits_above_iov_max(monkeypatch):
+    monkeypatch.setattr(run, "IOV_MAX", 5)
+    payloads = large_payloads(7)
+    conn = ShortConn(limit=1 << 30)
+    assert run.send_frames(conn, payloads, bytearray(4 * len(payloads))) == len(frames(payloads))
+    assert conn.data == frames(payloads)
+    assert max(conn.calls) == 5
+
+def test_send_frames_joins_small_frames():
+    payloads = [b"{}", b'{"a": 1}']
+    conn = ShortConn(limit=0)
+    assert run.send_frames(conn, payloads, bytearray(8)) == len(frames(payloads))
+    assert conn.data == frames(payloads)
+    assert conn.calls == []
+
+def send_in_background(sock, data):
+    thread = threading.Thread(target=sock.sendall, args=(data,))
+    thread.start()
+    return thread
+
+def test_frame_reader_grows_its_buffer():
+    a, b = socket.socketpair()
+    payloads = [b"x" * 10, bytes(range(256)) * 1000, b"y"]
+    thread = send_in_background(a, frames(payloads))
+    reader = run.FrameReader(max_frame_size=1 << 20, initial_size=1024)
+    try:
+        for p in payloads:
+            assert bytes(reader.read_frame(b)) == p
+        assert len(reader.buf) >= 256 * 1000
+        assert reader.bytes_received == len(frames(payloads))
+    finally:
+        thread.join()
+        a.close()
+        b.close()
+
+def test_frame_reader_rejects_frames_above_limit():
+    a, b = socket.socketpair()
+    a.sendall(struct.pack(">I", 4097) + b"z" * 16)
+    reader = run.FrameReader(max_frame_size=4096, initial_size=1024)
+    try:
+        with pytest.raises(ValueError):
+            reader.read_frame(b)
+        assert len(reader.buf) == 1024
+    finally:
+        a.close()
+        b.close()
+
+def test_frame_reader_raises_on_truncated_frame():
+    a, b = socket.socketpair()
+    a.sendall(struct.pack(">I", 100) + b"z" * 10)
+    a.close()
+    with pytest.raises(ConnectionError):
+        run.FrameReader().read_frame(b)
+    b.close()
+
+def serve_peer(path, name, received):
+    """Stand-in app-manager answering every request with its name and the request"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    reader = run.FrameReader()
+    try:
+        while True:
+            req = json.loads(bytes(reader.read_frame(sock)))
+            received.append(req)
+            if "Oversized" in req:
+                sock.sendall(struct.pack(">I", req["Oversized"]))
+                continue
+            run.write_frame(sock, {"peer": name, "request": req})
+    except ConnectionError:
+        pass
+    finally:
+        sock.close()
+
+def test_async_warden_serves_unix_peers(tmp_path):
+    path = str(tmp_path / "warden.sock")
+    warden = run.AsyncMockedWarden(sock=run.listen_unix(path, socket.SOMAXCONN), max_frame_size=4096, codec="json")
+    received = {"first": [], "second": []}
+    threads = []
+
+    async def exercise():
+        await warden.start()
+        for name in received:
+            threads.append(threading.Thread(target=serve_peer, args=(path, name, received[name]), daemon=True))
+            threads[-1].start()
+            await warden.wait_for_realms(len(threads))
+        # unnamed AF_UNIX peers are keyed by connection order
+        keys = await warden.wait_for_realms(2)
+        assert keys == [0, 1]
+
+        requests = [{"CheckStatus": str(i)} for i in range(20)]
+        responses = await asyncio.gather(*[warden.transaction(key, req) for req in requests for key in keys])
+        assert responses == [{"peer": name, "request": req} for req in requests for name in received]
+        # requests to one realm are written in the order they were issued
+        assert received["first"] == received["second"] == requests
+
+        with pytest.raises(ValueError):
+            await warden.transaction(keys[0], {"Oversized": 4097})
+        assert await warden.transaction(keys[1], {"CheckStatus": "after"}) == {"peer": "second", "request": {"CheckStatus": "after"}}
+        await warden.close()
+
+    asyncio.run(exercise())
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+def test_fake_realm_frame_limit_matches_run():
+    assert fake_realm.MAX_FRAME_SIZE == run.MAX_FRAME_SIZE
+
+def test_histogram_percentiles():
+    h = run.LatencyHistogram()
+    assert h.percentile(50) == 0
+    for v in range(1, 101):
+        h.record(v)
+    # values below 2 ** significant_bits get a bucket each
+    assert h.percentile(50) == 50
+    assert h.percentile(99) == 99
+    assert h.percentile(100) == 100
+    assert h.percentile(0) == 1
+
+def test_histogram_precision():
+    h = run.LatencyHistogram()
+    values = [1_000 * i for i in range(1, 1001)]
+    for v in values:
+        h.record(v)
+    for p in (50, 90, 99):
+        exact = values[round(len(values) * p / 100) - 1]
+        assert exact <= h.percentile(p) <= exact * 1.01
+    assert h.percentile(100) == h.max == values[-1]
+
+@pytest.mark.parametrize("depth", ["0", "-1"])
+def test_pipeline_depth_has_to_be_positive(depth):
+    with pytest.raises(SystemExit):
+        run.argument_parser().parse_args(["--pipeline-depth", depth])
+    assert run.argument_parser().parse_args(["--pipeline-depth", "1"]).pipeline_depth == 1
+
+def test_transaction_many_pipelines_in_windows(tmp_path):
+    path = str(tmp_path / "warden.sock")
+    host = run.MockedWarden(None, fake_realm=[], unix_socket=path, codec="json")
+    received = []
+    thread = threading.Thread(target=serve_peer, args=(path, "realm", received), daemon=True)
+    thread.start()
+    host.reconnect(timeout=5)
+    try:
+        requests = [{"CheckStatus": str(i)} for i in range(10)]
+        assert host.transaction_many(requests, window=3) == [{"peer": "realm", "request": req} for req in requests]
+        assert received == requests
+        for window in (0, -1):
+            with pytest.raises(ValueError):
+                host.transaction_many(requests, window)
+    finally:
+        host.conn.close()
+        host.sock.close()
+    thread.join(timeout=5)
+
+# The serial console of a realm provisioning the Test app, from README.md
+BOOT_LOG = """\
+[    2.320099] Warning: unable to open an initial console.
+[    2.365938] Freeing unused kernel memory: 36352K
+[    2.367138] Run /init as init process
+Running mdev -s
+Running ifup -a
+[    3.815278] e1000: eth0 NIC Link is Up 1000 Mbps Full Duplex, Flow Control: RX
+udhcpc: started, v1.37.0.git
+Setting IP address 0.0.0.0 on eth0
+udhcpc: broadcasting discover
+udhcpc: broadcasting select for 192.168.100.237, server 192.168.100.1
+udhcpc: lease of 192.168.100.237 obtained from 192.168.100.1, lease time 3600
+Setting IP address 192.168.100.237 on eth0
+Deleting routers
+route: SIOCDELRT: No such process
+Adding router 192.168.100.1
+Recreating /etc/resolv.conf
+ Adding DNS server 192.168.100.1
+
+Please press Enter to activate this console. 2024-07-31T11:38:47.483Z INFO  [app_manager] Reading config file: "/etc/app-manager/config.yml"
+2024-07-31T11:38:47.569Z INFO  [app_manager::manager] Connected to warden daemon
+2024-07-31T11:38:47.572Z INFO  [app_manager] Provishioning...
+2024-07-31T11:38:47.573Z INFO  [app_manager::manager] Waiting for provision info
+2024-07-31T11:38:47.590Z DEBUG [app_manager::manager] Received provision info: [ApplicationInfo { id: 5d63a211-e8aa-4179-ac22-af7e843a3f43, name: "Test app", version: "1.0", image_registry: "http://registry.com", image_part_uuid: 0178460a-ffea-4674-8e17-8530758c4c2e, data_part_uuid: 259c493c-e5d2-4fd4-a962-7efd45a0bd91 }]
+2024-07-31T11:38:47.593Z INFO  [app_manager::manager] Starting installation
+2024-07-31T11:38:47.637Z DEBUG [devicemapper::core::dm] Creating device crypt_0178460a-ffea-4674-8e17-8530758c4c2e (uuid=None)
+2024-07-31T11:38:47.667Z DEBUG [devicemapper::core::dm] Resuming device crypt_0178460a-ffea-4674-8e17-8530758c4c2e
+[    5.389424] EXT4-fs (dm-0): mounting ext2 file system using the ext4 subsystem
+[    5.396872] EXT4-fs (dm-0): warning: mounting unchecked fs, running e2fsck is recommended
+[    5.407595] EXT4-fs (dm-0): mounted filesystem 77af6112-6ce4-4ca2-b1d5-00bf98283103 r/w without journal. Quota mode: none.
+[    5.408214] ext2 filesystem being mounted at /apps/5d63a211-e8aa-4179-ac22-af7e843a3f43/image supports timestamps until 2038-01-19 (0x7fffffff)
+2024-07-31T11:38:47.718Z INFO  [app_manager::app] Installing application
+2024-07-31T11:38:47.867Z DEBUG [devicemapper::core::dm] Creating device crypt_259c493c-e5d2-4fd4-a962-7efd45a0bd91 (uuid=None)
+2024-07-31T11:38:47.875Z DEBUG [devicemapper::core::dm] Resuming device crypt_259c493c-e5d2-4fd4-a962-7efd45a0bd91
+2024-07-31T11:38:47.879Z INFO  [app_manager::app] Mounting data partition
+[    5.580489] EXT4-fs (dm-1): mounting ext2 file system using the ext4 subsystem
+[    5.582859] EXT4-fs (dm-1): warning: mounting unchecked fs, running e2fsck is recommended
+[    5.584870] EXT4-fs (dm-1): mounted filesystem 2e07ad5f-c2f9-40e3-9869-68f21676a2a9 r/w without journal. Quota mode: none.
+[    5.585291] ext2 filesystem being mounted at /apps/5d63a211-e8aa-4179-ac22-af7e843a3f43/data supports timestamps until 2038-01-19 (0x7fffffff)
+2024-07-31T11:38:47.887Z INFO  [app_manager::app] Mounting overlayfs
+2024-07-31T11:38:47.929Z INFO  [app_manager::manager] Finished installing 5d63a211-e8aa-4179-ac22-af7e843a3f43
+2024-07-31T11:38:47.930Z INFO  [app_manager::manager] Provisioning finished
+2024-07-31T11:38:47.938Z INFO  [app_manager::manager] Starting 5d63a211-e8aa-4179-ac22-af7e843a3f43
+2024-07-31T11:38:47.978Z INFO  [app_manager] Applications started entering event loop
+"""
+
+def test_serial_timeline_phases():
+    timeline = run.SerialTimeline()
+    timeline.new_boot(launch=0.0)
+    # a second per line
+    for t, line in enumerate(BOOT_LOG.splitlines(), 1):
+        timeline.feed(line, now=float(t))
+
+    boot = timeline.boots[-1]
+    assert boot["events"][0] == {"event": "init_started", "t": 3.0, "guest_time": 2.367138, "arg": None, "line": "[    2.367138] Run /init as init process"}
+    assert run.SerialTimeline.phases(boot) == {
+        "kernel_boot": 3.0,
+        "userspace_init": 4.0,
+        "dhcp": 4.0,
+        "app_manager_connect": 1.0,
+        "installation": 17.0,
+        "app_start": 2.0,
+        # creating to resuming both crypt devices, resuming to mounting dm-0 and dm-1
+        "dm_crypt": 2.0,
+        "mkfs_mount": 7.0,
+    }
+    assert run.SerialTimeline.provisioning(boot) == {"install": 16.0, "per_app_install": [16.0], "measure": 0.0, "start": 0.0}
+
+    timeline.feed("[    0.000000] Booting Linux on physical CPU 0x0000000000 [0x000f0510]", now=100.0)
+    assert len(timeline.boots) == 2
+    assert timeline.boots[-1]["launch"] == 100.0
+    assert run.SerialTimeline.provisioning(timeline.boots[-1]) is None
+
+class StatusHost():
+    """Stand-in for MockedWarden.check_apps answering with scripted statuses"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = []
+
+    def check_apps(self, ids, window = 16):
+        self.calls.append((list(ids), window))
+        statuses = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        return [{status: []} for status in statuses]
+
+def test_status_watcher_backs_off_while_idle():
+    ids = [run.APP_ID, uuid.UUID(int=1)]
+    host = StatusHost([
+        ["ApplicationNotStarted", "ApplicationIsRunning"],
+        ["ApplicationNotStarted", "ApplicationIsRunning"],
+        ["ApplicationNotStarted", "ApplicationIsRunning"],
+        ["ApplicationNotStarted", "ApplicationIsRunning"],
+        ["ApplicationIsRunning", "ApplicationIsRunning"],
+    ])
+    watcher = run.StatusWatcher(host, ids, min_interval=0.01, max_interval=0.05, backoff=2.0, window=4)
+    seen = []
+    watcher.on_change(seen.append)
+
+    intervals = []
+    for _ in range(5):
+        watcher.poll()
+        intervals.append(watcher.interval)
+    assert intervals == [0.01, 0.02, 0.04, 0.05, 0.01]
+    assert host.calls[0] == ([str(id) for id in ids], 4)
+    assert [(c.id, c.old, c.new) for c in seen] == [
+        (str(ids[0]), None, "ApplicationNotStarted"),
+        (str(ids[1]), None, "ApplicationIsRunning"),
+        (str(ids[0]), "ApplicationNotStarted", "ApplicationIsRunning"),
+    ]
+
+def test_status_watcher_wait_for():
+    host = StatusHost([["ApplicationNotStarted"], ["ApplicationNotStarted"], ["ApplicationIsRunning"]])
+    watcher = run.StatusWatcher(host, [run.APP_ID], min_interval=0.001, max_interval=0.002)
+    assert watcher.wait_for("ApplicationIsRunning", timeout=5) == {str(run.APP_ID): {"ApplicationIsRunning": []}}
+    assert watcher.polls == 3
+
+    with pytest.raises(TimeoutError):
+        watcher.wait_for("ApplicationExited", timeout=0.05)
+
+def test_build_layout_matches_gpt_image(tmp_path):
+    Disk = pytest.importorskip("gpt_image.disk").Disk
+    base = run.default_apps()[0]
+    apps = [run.AppDisk(replace(base, id="", image_part_uuid="", data_part_uuid=""), 3 << 20, 1 << 20) for _ in range(3)]
+    layout, apps = run.build_layout(apps)
+
+    content = tmp_path / "content"
+    content.write_bytes(b"content of the first data partition")
+    specs = list(layout.partitions)
+    specs[1] = replace(specs[1], content=str(content))
+    layout = replace(layout, partitions=tuple(specs))
+
+    path = tmp_path / "disk.raw"
+    run.create_disk(str(path), layout)
+    disk = Disk.open(str(path))
+    entries = [e for e in disk.table.partitions.entries if e.partition_name]
+
+    guids = [guid for app in apps for guid in (app.image_part_uuid, app.data_part_uuid)]
+    assert [e.partition_guid for e in entries] == guids
+    assert len({uuid.UUID(app.id) for app in apps}) == len(apps)
+
+    end = 0
+    for spec, e in zip(layout.partitions, entries):
+        assert e.partition_name == spec.name
+        assert e.first_lba % layout.alignment == 0
+        assert e.first_lba > end
+        assert (e.last_lba - e.first_lba + 1) * run.SECTOR_SIZE == spec.size
+        end = e.last_lba
+    assert end <= disk.table.primary_header.last_usable_lba
+    assert path.stat().st_size == layout.size
+
+    with open(path, "rb") as f:
+        f.seek(entries[1].first_lba * run.SECTOR_SIZE)
+        assert f.read(len(content.read_bytes())) == content.read_bytes()
+
+def test_build_layout_rejects_too_many_apps():
+    with pytest.raises(ValueError):
+        run.build_layout([run.AppDisk(run.default_apps()[0])] * (run.MAX_PARTITIONS // 2 + 1))
+
+def test_clone_disk_replaces_disk_of_another_template(tmp_path):
+    first, second = tmp_path / "first.raw", tmp_path / "second.raw"
+    first.write_bytes(b"first")
+    second.write_bytes(b"second")
+    disk = str(tmp_path / "disk.raw")
+
+    run.clone_disk(str(first), disk, "copy")
+    with open(disk, "r+b") as f:
+        f.write(b"FIRST")
+    assert run.clone_disk(str(first), disk, "copy") == disk
+    assert (tmp_path / "disk.raw").read_bytes() == b"FIRST"
+
+    run.clone_disk(str(second), disk, "copy")
+    assert (tmp_path / "disk.raw").read_bytes() == b"second"
+
+def test_encrypt_aes_cbc_plain_matches_per_sector_cbc(tmp_path):
+    ciphers = pytest.importorskip("cryptography.hazmat.primitives.ciphers")
+    key = bytes(range(32))
+    # more sectors than fit in 16 bits, ending in a partial chunk
+    sectors = (1 << 16) + 5
+    plain = os.urandom(sectors * run.SECTOR_SIZE)
+    (tmp_path / "plain").write_bytes(plain)
+    run.encrypt_aes_cbc_plain(str(tmp_path / "plain"), str(tmp_path / "encrypted"), key, chunk_size=1024 * 1024)
+
+    expected = bytearray()
+    aes = ciphers.algorithms.AES(key)
+    for sector in range(sectors):
+        encryptor = ciphers.Cipher(aes, ciphers.modes.CBC(struct.pack("<I12x", sector))).encryptor()
+        expected += encryptor.update(plain[sector * run.SECTOR_SIZE:(sector + 1) * run.SECTOR_SIZE])
+    assert (tmp_path / "encrypted").read_bytes() == expected
+
+def test_parse_batch():
+    steps = run.parse_batch(run.command_parser(), [
+        "check_app; repeat 3 start_app --uuid 8e609c58-6b18-59f8-9a85-d81659b4e593 # start it",
+        "",
+        "# only a comment",
+        "wait_until ApplicationIsRunning",
+    ])
+    assert [(count, text) for count, text, _ in steps] == [
+        (1, "check_app"),
+        (3, "repeat 3 start_app --uuid 8e609c58-6b18-59f8-9a85-d81659b4e593"),
+        (1, "wait_until ApplicationIsRunning"),
+    ]
+    assert steps[0][2].uuid == run.APP_ID
+    assert steps[1][2].command == "start_app"
+    assert steps[1][2].uuid == uuid.UUID("8e609c58-6b18-59f8-9a85-d81659b4e593")
+    assert steps[2][2].status == "ApplicationIsRunning"
+
+@pytest.mark.parametrize("line", ["repeat check_app", "repeat 3", "repeat -1 check_app"])
+def test_parse_batch_rejects_bad_repeat(line):
+    with pytest.raises(ValueError):
+        run.parse_batch(run.command_parser(), [line])